@@ -0,0 +1,225 @@
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from reset_running_total_numpy import carry_column, day_numbers, peer_values, run_starts, segmented_cummin, segmented_cumsum
+from ledger import open_ledger
+
+
+# Same logic as part 1 and the recursive_lower_bounds CTE in FIFO_stock_level_projections.py, but over NumPy arrays.
+# Part 1 sorts the transactions once and calculates all running totals and lower bounds over the sorted arrays.
+# The recursive lower bounds are solved per product: only products whose lower bounds still changed in the
+# previous iteration are recalculated.
+
+TRANSACTIONS_WITH_RUNNING_TOTALS = "select * from fifo_transactions"
+
+TRANSACTIONS = "select product_code, reference_number, produced_qty, ordered_qty, potential_waste_qty, transaction_date, sort_order from fifo_transactions"
+
+# transactions with running totals from the compact ledger (see ledger.py), already in the order of the lower bounds
+COMPACT_TRANSACTIONS_WITH_RUNNING_TOTALS = """
+select product_id, reference_id, produced_qty, ordered_qty, potential_waste_qty, day, sort_order, ordinal, RT_produced, RT_ordered, RT_potential_waste
+from compact_ledger
+order by product_id, ordinal
+"""
+
+MAX_RECURSION_DEPTH = 10 # same safeguard as the recursive CTE
+
+
+def lower_bound(values, segment_starts, peer_starts, carry_min=None):
+    """`case when 0 < min(values) over (...) then 0 else -min(values) over (...) end`"""
+    running_min = peer_values(segmented_cummin(values, segment_starts), peer_starts)
+    if carry_min is not None:
+        running_min = np.minimum(running_min, carry_min)
+    return np.maximum(0, -running_min)
+
+
+def solve_lower_bounds(product_ids, peer_starts, RT_produced, RT_ordered, RT_potential_waste, max_recursion_depth=MAX_RECURSION_DEPTH,
+                       carry_min_missed_sales=None, carry_min_waste=None):
+    """Fixpoint of the LB_RT_missed_sales / LB_RT_waste alternation.
+
+    All arrays are sorted by product, transaction_date, sort_order and reference_number; `peer_starts` marks
+    the first row of every group of rows that share that full sort key.
+    Returns (LB_RT_missed_sales, LB_RT_waste, recursion_depth), recursion_depth being one value per row
+    (the depth of the last iteration of the product, as in recursive_lower_bounds).
+
+    The optional carry arrays hold, per row, the minimum of `RT_produced - RT_waste - RT_ordered` and of
+    `RT_ordered - RT_missed_sales - RT_potential_waste` over the (already solved) earlier transactions of the product."""
+    n = len(product_ids)
+    LB_RT_missed_sales = np.zeros(n, dtype=np.int64)
+    LB_RT_waste = np.zeros(n, dtype=np.int64)
+    recursion_depth = np.zeros(n, dtype=np.int64)
+
+    # every product does at least one iteration, like the anchor of the recursive CTE (prev = -1)
+    active = np.arange(n)
+    depth = 0
+    while len(active) > 0 and depth + 1 < max_recursion_depth:
+        depth += 1
+        segment_starts = run_starts(product_ids[active])
+        active_peer_starts = peer_starts[active] | segment_starts
+        prev_missed_sales = LB_RT_missed_sales[active]
+        prev_waste = LB_RT_waste[active]
+
+        missed_sales = lower_bound(RT_produced[active] - prev_waste - RT_ordered[active], segment_starts, active_peer_starts,
+                                   None if carry_min_missed_sales is None else carry_min_missed_sales[active])
+        waste = lower_bound(RT_ordered[active] - prev_missed_sales - RT_potential_waste[active], segment_starts, active_peer_starts,
+                            None if carry_min_waste is None else carry_min_waste[active])
+
+        LB_RT_missed_sales[active] = missed_sales
+        LB_RT_waste[active] = waste
+        recursion_depth[active] = depth
+
+        # a product needs another iteration if any of its lower bounds went up
+        changed = (missed_sales > prev_missed_sales) | (waste > prev_waste)
+        changed_products = np.unique(product_ids[active][changed])
+        active = active[np.isin(product_ids[active], changed_products)]
+
+    return LB_RT_missed_sales, LB_RT_waste, recursion_depth
+
+
+def sort_keys(transactions):
+    """Integer arrays (product, transaction_date, sort_order, reference_number) with the same order as the string and date columns.
+    If the transactions have a scenario_id column (see scenarios.py), the products are partitioned by scenario_id and product_code."""
+    product_codes, product_ids = np.unique(transactions['product_code'].to_numpy(), return_inverse=True)
+    if 'scenario_id' in transactions.column_names:
+        product_ids = np.unique(transactions['scenario_id'].to_numpy(), return_inverse=True)[1] * len(product_codes) + product_ids
+    return (
+        product_ids,
+        day_numbers(transactions['transaction_date']),
+        transactions['sort_order'].to_numpy(),
+        np.unique(transactions['reference_number'].to_numpy(), return_inverse=True)[1],
+    )
+
+
+def part1_table(transactions):
+    """Part 1 in a single pass: sorts an arrow table of transactions (without running totals) once, and calculates
+    RT_produced, RT_ordered, RT_potential_waste, LB_RT_missed_sales and LB_RT_waste over the sorted arrays.
+    Returns an arrow table with the same columns as part1 in FIFO_stock_level_projections.py, sorted by
+    product_code, transaction_date, sort_order and reference_number."""
+    product_ids, transaction_date, sort_order, reference_ids = sort_keys(transactions)
+    order = np.lexsort((reference_ids, sort_order, transaction_date, product_ids))
+    transactions = transactions.take(order)
+    product_starts = run_starts(product_ids[order])
+    peer_starts = run_starts(product_ids[order], transaction_date[order], sort_order[order], reference_ids[order])
+
+    running_totals = {
+        f'RT_{name}': peer_values(segmented_cumsum(transactions[f'{name}_qty'].to_numpy().astype(np.int64), product_starts), peer_starts)
+        for name in ['produced', 'ordered', 'potential_waste']
+    }
+    lower_bounds = {
+        'LB_RT_missed_sales': lower_bound(running_totals['RT_produced'] - running_totals['RT_ordered'], product_starts, peer_starts),
+        'LB_RT_waste': lower_bound(running_totals['RT_ordered'] - running_totals['RT_potential_waste'], product_starts, peer_starts),
+    }
+    for name, values in {**running_totals, **lower_bounds}.items():
+        transactions = transactions.append_column(name, pa.array(values))
+    return transactions
+
+
+def part1(con, transactions_sql=TRANSACTIONS):
+    """Part 1 for the transactions returned by `transactions_sql`, as a relation."""
+    return con.from_arrow(part1_table(con.sql(transactions_sql).to_arrow_table()))
+
+
+def stock_levels_table(transactions):
+    """Stock levels for an arrow table of transactions with running totals, sorted by product_code, transaction_date,
+    sort_order and reference_number. Returns an arrow table with the same columns as stock_levels in FIFO_stock_level_projections.py.
+
+    If the transactions also have carry_min_missed_sales, carry_min_waste, carry_RT_missed_sales and carry_RT_waste
+    columns (see solve_lower_bounds), they continue from the solved earlier transactions of their product."""
+    if 'ordinal' in transactions.column_names: # from compact_transactions
+        product_ids = transactions['product_id'].to_numpy()
+        peer_starts = run_starts(product_ids, transactions['ordinal'].to_numpy())
+    else:
+        product_ids, transaction_date, sort_order, reference_ids = sort_keys(transactions)
+        peer_starts = run_starts(product_ids, transaction_date, sort_order, reference_ids)
+    RT_produced = transactions['RT_produced'].to_numpy().astype(np.int64)
+    RT_ordered = transactions['RT_ordered'].to_numpy().astype(np.int64)
+    RT_potential_waste = transactions['RT_potential_waste'].to_numpy().astype(np.int64)
+    LB_RT_missed_sales, LB_RT_waste, _ = solve_lower_bounds(
+        product_ids, peer_starts, RT_produced, RT_ordered, RT_potential_waste,
+        carry_min_missed_sales=carry_column(transactions, 'carry_min_missed_sales', np.iinfo(np.int64).max),
+        carry_min_waste=carry_column(transactions, 'carry_min_waste', np.iinfo(np.int64).max),
+    )
+
+    # lag(...) over (partition by product_code ...): null on the first row of a product, unless it continues earlier transactions
+    first_rows = run_starts(product_ids)
+    prev_missed_sales = np.roll(LB_RT_missed_sales, 1)
+    prev_waste = np.roll(LB_RT_waste, 1)
+    no_lag = first_rows
+    if 'carry_RT_missed_sales' in transactions.column_names:
+        carry_RT_missed_sales = transactions['carry_RT_missed_sales']
+        prev_missed_sales[first_rows] = carry_column(transactions, 'carry_RT_missed_sales', 0)[first_rows]
+        prev_waste[first_rows] = carry_column(transactions, 'carry_RT_waste', 0)[first_rows]
+        no_lag = first_rows & carry_RT_missed_sales.is_null().to_numpy(zero_copy_only=False)
+    missed_sales_qty = pa.array(LB_RT_missed_sales - prev_missed_sales, mask=no_lag)
+    waste_qty = pa.array(LB_RT_waste - prev_waste, mask=no_lag)
+    sold_qty = pa.array(transactions['ordered_qty'].to_numpy() - (LB_RT_missed_sales - prev_missed_sales), mask=no_lag)
+
+    result = pa.table({
+        **({'scenario_id': transactions['scenario_id']} if 'scenario_id' in transactions.column_names else {}),
+        'product_code': transactions['product_code'],
+        'reference_number': transactions['reference_number'],
+        'sort_order': transactions['sort_order'],
+        'transaction_date': transactions['transaction_date'],
+        'produced_qty': transactions['produced_qty'],
+        'ordered_qty': transactions['ordered_qty'],
+        'potential_waste_qty': transactions['potential_waste_qty'],
+        'sold_qty': sold_qty,
+        'missed_sales_qty': missed_sales_qty,
+        'waste_qty': waste_qty,
+        'RT_produced': RT_produced,
+        'RT_ordered': RT_ordered,
+        'RT_potential_waste': RT_potential_waste,
+        'RT_sold': RT_ordered - LB_RT_missed_sales,
+        'RT_missed_sales': LB_RT_missed_sales,
+        'RT_waste': LB_RT_waste,
+        'stock': RT_produced - RT_ordered + LB_RT_missed_sales - LB_RT_waste,
+    })
+    return result
+
+
+def compact_transactions(con):
+    """Transactions with running totals from the compact ledger, as an arrow table in the order of the lower bounds.
+    product_code and reference_number are dictionary arrays over the ledger dictionaries, so no strings are sorted
+    or copied. The reference numbers of expirations ('WASTE ' prefix) point to a second copy of the reference dictionary."""
+    transactions = con.sql(COMPACT_TRANSACTIONS_WITH_RUNNING_TOTALS).to_arrow_table()
+    product_codes = con.sql("select product_code from product_dictionary order by product_id").to_arrow_table()['product_code'].combine_chunks()
+    reference_numbers = con.sql("select reference_number from reference_dictionary order by reference_id").to_arrow_table()['reference_number'].combine_chunks()
+    sort_order = transactions['sort_order'].to_numpy()
+    reference_ids = transactions['reference_id'].to_numpy() + np.where(sort_order >= 3, len(reference_numbers), 0).astype(np.int32)
+    for name in ['produced_qty', 'ordered_qty', 'potential_waste_qty']:
+        transactions = transactions.set_column(transactions.column_names.index(name), name, transactions[name].cast(pa.int64()))
+    return transactions.drop_columns(['reference_id', 'day', 'sort_order']).append_column(
+        'product_code', pa.DictionaryArray.from_arrays(transactions['product_id'].combine_chunks(), product_codes)
+    ).append_column(
+        'reference_number', pa.DictionaryArray.from_arrays(pa.array(reference_ids), pa.concat_arrays([reference_numbers, pc.binary_join_element_wise('WASTE ', reference_numbers, '')]))
+    ).append_column(
+        'transaction_date', transactions['day'].cast(pa.date32())
+    ).append_column(
+        'sort_order', transactions['sort_order'].cast(pa.int32())
+    )
+
+
+def stock_levels(con, transactions_with_running_totals_sql=TRANSACTIONS_WITH_RUNNING_TOTALS):
+    """Stock levels for the transactions returned by `transactions_with_running_totals_sql`, as a relation."""
+    return con.from_arrow(stock_levels_table(con.sql(f"""
+        select * from ({transactions_with_running_totals_sql})
+        order by product_code, transaction_date, sort_order, reference_number
+    """).to_arrow_table()))
+
+
+def stock_levels_compact(con):
+    """Stock levels from the compact ledger, as a relation (in the order of product_id and ordinal)."""
+    return con.from_arrow(stock_levels_table(compact_transactions(con)))
+
+
+if __name__ == '__main__':
+    con = open_ledger()
+
+    part1_numpy = part1(con)
+    con.sql("select * from part1_numpy where product_code = 'cupc01'").show()
+
+    stock_levels_numpy = stock_levels(con)
+    con.sql("select * from stock_levels_numpy where product_code = 'cupc01' order by transaction_date, sort_order, reference_number").show()
+
+    stock_levels_numpy = stock_levels_compact(con)
+    con.sql("select * from stock_levels_numpy where product_code = 'cupc01'").show()
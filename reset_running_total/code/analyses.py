@@ -0,0 +1,292 @@
+import argparse
+
+from tables import quote
+
+
+# The analyses of reset_running_total.py and FIFO_stock_level_projections.py, reading their transactions
+# (and running totals) from the shared ledger instead of building them from the csv files every time.
+
+RESET_RUNNING_TOTAL = """
+with min_running_total_v1 as (
+    select
+        product_code,
+        reference_number,
+        qty,
+        transaction_date,
+        sort_order,
+        running_total_v1,
+        min(running_total_v1) over (partition by product_code order by transaction_date, sort_order) as min_running_total_v1
+    from
+        {transactions}
+),
+running_total_v2 as (
+    select
+        product_code,
+        reference_number,
+        qty,
+        transaction_date,
+        sort_order,
+        running_total_v1,
+        min_running_total_v1,
+        case
+            when min_running_total_v1 >= 0 then running_total_v1
+            else running_total_v1 - min_running_total_v1
+        end as running_total_v2
+    from
+        min_running_total_v1
+)
+
+select * from running_total_v2
+order by product_code, transaction_date, sort_order
+"""
+
+PART1 = """
+select
+    *,
+    case
+        when 0 < min(RT_produced - RT_ordered) over (partition by product_code order by transaction_date, sort_order, reference_number)
+            then 0
+        else -min(RT_produced - RT_ordered) over (partition by product_code order by transaction_date, sort_order, reference_number)
+    end as LB_RT_missed_sales,
+    case
+        when 0 < min(RT_ordered - RT_potential_waste) over (partition by product_code order by transaction_date, sort_order, reference_number)
+            then 0
+        else -min(RT_ordered - RT_potential_waste) over (partition by product_code order by transaction_date, sort_order, reference_number)
+    end as LB_RT_waste
+from
+    {fifo_transactions}
+"""
+
+RECURSIVE_STEP = """
+    select
+        recursion_depth + 1 as recursion_depth,
+        product_code,
+        reference_number,
+        produced_qty,
+        ordered_qty,
+        potential_waste_qty,
+        transaction_date,
+        sort_order,
+        RT_produced,
+        RT_ordered,
+        RT_potential_waste,
+        LB_RT_missed_sales as prev_LB_RT_missed_sales,
+        LB_RT_waste as prev_LB_RT_waste,
+        case
+            when 0 < min(RT_produced - LB_RT_waste - RT_ordered) over (partition by product_code order by transaction_date, sort_order, reference_number)
+                then 0
+            else -min(RT_produced - LB_RT_waste - RT_ordered) over (partition by product_code order by transaction_date, sort_order, reference_number)
+        end as LB_RT_missed_sales,
+        case
+            when 0 < min(RT_ordered - LB_RT_missed_sales - RT_potential_waste) over (partition by product_code order by transaction_date, sort_order, reference_number)
+                then 0
+            else -min(RT_ordered - LB_RT_missed_sales - RT_potential_waste) over (partition by product_code order by transaction_date, sort_order, reference_number)
+        end as LB_RT_waste
+    from
+        calculate_lower_bounds
+    where
+        recursion_depth + 1 < 10 -- safeguards
+        and product_code in
+            (
+                select product_code
+                from calculate_lower_bounds
+                group by product_code
+                having
+                    count(case when LB_RT_missed_sales - prev_LB_RT_missed_sales > 0 then 1 end) > 0
+                    or count(case when LB_RT_waste - prev_LB_RT_waste > 0 then 1 end) > 0
+            )
+"""
+
+RECURSIVE_LOWER_BOUNDS = """
+with recursive calculate_lower_bounds
+    (recursion_depth, product_code, reference_number, produced_qty, ordered_qty, potential_waste_qty,transaction_date, sort_order, RT_produced, RT_ordered, RT_potential_waste, prev_LB_RT_missed_sales, prev_LB_RT_waste, LB_RT_missed_sales, LB_RT_waste)
+as (
+    -- anchor
+    select
+        0 as recursion_depth,
+        product_code,
+        reference_number,
+        produced_qty,
+        ordered_qty,
+        potential_waste_qty,
+        transaction_date,
+        sort_order,
+        RT_produced,
+        RT_ordered,
+        RT_potential_waste,
+        -1 as prev_LB_RT_missed_sales,
+        -1 as prev_LB_RT_waste,
+        0 as LB_RT_missed_sales,
+        0 as LB_RT_waste
+    from
+        {fifo_transactions}
+    UNION ALL
+    -- recursive step
+""" + RECURSIVE_STEP + """
+)
+
+select * from calculate_lower_bounds
+"""
+
+# Only keeps the latest iteration of every transaction: `using key` (DuckDB 1.3 or later) replaces the rows of a
+# (product_code, reference_number) instead of appending a copy of the transaction table for every recursion depth.
+# The anchor starts from the part 1 lower bounds ({part1}: the part 1 query, or an already calculated part1 table), so
+# products with all part 1 lower bounds equal to 0 never enter the recursive step.
+RECURSIVE_LOWER_BOUNDS_LATEST_ONLY = """
+with recursive calculate_lower_bounds
+    (recursion_depth, product_code, reference_number, produced_qty, ordered_qty, potential_waste_qty,transaction_date, sort_order, RT_produced, RT_ordered, RT_potential_waste, prev_LB_RT_missed_sales, prev_LB_RT_waste, LB_RT_missed_sales, LB_RT_waste)
+    using key (product_code, reference_number)
+as (
+    -- anchor: part 1 (recursion depth 1 of the full history CTE)
+    select
+        1 as recursion_depth,
+        product_code,
+        reference_number,
+        produced_qty,
+        ordered_qty,
+        potential_waste_qty,
+        transaction_date,
+        sort_order,
+        RT_produced,
+        RT_ordered,
+        RT_potential_waste,
+        0 as prev_LB_RT_missed_sales,
+        0 as prev_LB_RT_waste,
+        LB_RT_missed_sales,
+        LB_RT_waste
+    from
+        {part1}
+    UNION
+    -- recursive step: only sees the rows of the previous iteration
+""" + RECURSIVE_STEP + """
+)
+
+select * from calculate_lower_bounds
+"""
+
+# With the full history, only the rows of the last recursion depth of every product are kept.
+FILTERED_LOWER_BOUNDS_RESULT = """
+max_recursion_depth as (
+    select
+        product_code,
+        max(recursion_depth) as max_recursion_depth
+    from
+        recursive_lower_bounds
+    group by
+        product_code
+),
+filtered_lower_bounds_result as (
+    select
+        recursive_lower_bounds.*
+    from
+        recursive_lower_bounds
+        inner join max_recursion_depth
+            on (
+                recursive_lower_bounds.product_code = max_recursion_depth.product_code
+                and recursive_lower_bounds.recursion_depth = max_recursion_depth.max_recursion_depth
+            )
+)"""
+
+# With the latest iteration only, there already is exactly one row per transaction.
+LATEST_LOWER_BOUNDS_RESULT = """
+filtered_lower_bounds_result as (
+    select * from recursive_lower_bounds
+)"""
+
+STOCK_LEVELS = """
+with recursive_lower_bounds as (
+{recursive_lower_bounds}
+),
+{filtered_lower_bounds_result},
+calculate_stock_levels as (
+    select
+        product_code,
+        reference_number,
+        sort_order,
+        transaction_date,
+        produced_qty,
+        ordered_qty,
+        potential_waste_qty,
+        ordered_qty - (LB_RT_missed_sales - lag(LB_RT_missed_sales) over (partition by product_code order by transaction_date, sort_order, reference_number)) as sold_qty,
+        LB_RT_missed_sales - lag(LB_RT_missed_sales) over (partition by product_code order by transaction_date, sort_order, reference_number) as missed_sales_qty,
+        LB_RT_waste - lag(LB_RT_waste) over (partition by product_code order by transaction_date, sort_order, reference_number) as waste_qty,
+        RT_produced,
+        RT_ordered,
+        RT_potential_waste,
+        RT_ordered - LB_RT_missed_sales as RT_sold,
+        LB_RT_missed_sales as RT_missed_sales,
+        LB_RT_waste as RT_waste,
+        RT_produced - RT_ordered + LB_RT_missed_sales - LB_RT_waste as stock
+    from
+        filtered_lower_bounds_result
+)
+
+select * from calculate_stock_levels
+"""
+
+
+def scoped(view, product_codes=None, product_prefix=None):
+    """`view`, or a subquery with the same name that only holds the given products (a list of product codes and/or
+    a product code prefix). The filter sits directly on the scan of the ledger, below all windows and the recursion,
+    so only the partitions of these products are calculated."""
+    conditions = []
+    if product_codes is not None:
+        conditions.append(f"product_code in ({', '.join(quote(product_code) for product_code in product_codes)})" if product_codes else 'false')
+    if product_prefix is not None:
+        conditions.append(f"starts_with(product_code, {quote(product_prefix)})")
+    if not conditions:
+        return view
+    return f"(select * from {view} where {' and '.join(conditions)}) as {view}"
+
+
+def result1(con, product_codes=None, product_prefix=None):
+    """Question 1: can we fill the orders?"""
+    return con.sql(RESET_RUNNING_TOTAL.format(transactions=scoped('fill_transactions', product_codes, product_prefix)))
+
+
+def result2(con, product_codes=None, product_prefix=None):
+    """Question 2: will it expire?"""
+    return con.sql(RESET_RUNNING_TOTAL.format(transactions=scoped('expiry_transactions', product_codes, product_prefix)))
+
+
+def part1(con, product_codes=None, product_prefix=None):
+    """Part 1: initial lower bound calculations."""
+    return con.sql(PART1.format(fifo_transactions=scoped('fifo_transactions', product_codes, product_prefix)))
+
+
+def recursive_lower_bounds_sql(latest_only=False, product_codes=None, product_prefix=None, part1=None):
+    if not latest_only:
+        return RECURSIVE_LOWER_BOUNDS.format(fifo_transactions=scoped('fifo_transactions', product_codes, product_prefix))
+    return RECURSIVE_LOWER_BOUNDS_LATEST_ONLY.format(
+        part1=scoped(part1, product_codes, product_prefix) if part1 else
+            f"({PART1.format(fifo_transactions=scoped('fifo_transactions', product_codes, product_prefix))}) as part1")
+
+
+def recursive_lower_bounds(con, latest_only=False, product_codes=None, product_prefix=None, part1=None):
+    """Part 2: recursive lower bound calculations, with the full history of iterations or only the latest one.
+    `part1` is the name of an already calculated part1 table, which the latest only recursion starts from."""
+    return con.sql(recursive_lower_bounds_sql(latest_only, product_codes, product_prefix, part1))
+
+
+def stock_levels(con, latest_only=False, lower_bounds=None, product_codes=None, product_prefix=None):
+    """Part 2: stock levels from the lower bounds of the last iteration.
+    `lower_bounds` is the name of an already calculated recursive_lower_bounds table (calculated with the same `latest_only`).
+    `product_codes` and `product_prefix` limit the calculation to those products (see scoped)."""
+    return con.sql(STOCK_LEVELS.format(
+        recursive_lower_bounds=f'select * from {scoped(lower_bounds, product_codes, product_prefix)}' if lower_bounds else
+            recursive_lower_bounds_sql(latest_only, product_codes, product_prefix),
+        filtered_lower_bounds_result=LATEST_LOWER_BOUNDS_RESULT if latest_only else FILTERED_LOWER_BOUNDS_RESULT,
+    ))
+
+
+if __name__ == '__main__':
+    import runtime # not at the top: runtime (through profiling and sharded) imports this module
+
+    parser = argparse.ArgumentParser(description='Questions 1 and 2, part 1 and the stock levels of product cupc01.')
+    runtime.add_arguments(parser)
+    con = runtime.connect_from_args(parser.parse_args())
+
+    result1(con, product_codes=['cupc01']).show()
+    result2(con, product_codes=['cupc01']).show()
+    part1(con, product_codes=['cupc01']).order('transaction_date, sort_order, reference_number').show()
+    stock_levels(con, latest_only=True, product_codes=['cupc01']).order('transaction_date, sort_order, reference_number').show()
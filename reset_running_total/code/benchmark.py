@@ -0,0 +1,94 @@
+import argparse
+import csv
+import multiprocessing
+import os
+import resource
+import time
+
+import duckdb # documentation available on https://duckdb.org/docs/api/python/overview
+
+import analyses
+from generate_data import generate
+from ledger import build_ledger
+from sharded import shard_connection
+
+
+# Scaling benchmark: generates synthetic data of increasing size and times every step of the analyses.
+# Every step runs in a fresh process, so its peak RSS is not inflated by earlier steps.
+
+SIZES = [10_000, 100_000, 1_000_000]
+
+STEPS = {
+    'question1': analyses.result1,
+    'question2': analyses.result2,
+    'part1': analyses.part1,
+    'recursive_lower_bounds': analyses.recursive_lower_bounds,
+    'stock_levels': analyses.stock_levels,
+}
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 # kilobytes on linux
+
+
+def run_ledger(data_dir, database):
+    start = time.perf_counter()
+    con = build_ledger(duckdb.connect(database), data_dir)
+    seconds = time.perf_counter() - start
+    rows = con.sql("select count(*) from ledger").fetchone()[0]
+    con.close()
+    return {'rows': rows, 'seconds': seconds, 'peak_rss_mb': peak_rss_mb(), 'recursion_depth': None}
+
+
+def run_step(step, database):
+    con = shard_connection(database, 0, 1)
+    start = time.perf_counter()
+    # materialize the result, so no part of the query can be optimized away
+    STEPS[step](con).to_table('benchmark_result')
+    seconds = time.perf_counter() - start
+    recursion_depth = None
+    if step == 'recursive_lower_bounds':
+        recursion_depth = con.sql("select max(recursion_depth) from benchmark_result").fetchone()[0]
+    rows = con.sql("select count(*) from benchmark_result").fetchone()[0]
+    return {'rows': rows, 'seconds': seconds, 'peak_rss_mb': peak_rss_mb(), 'recursion_depth': recursion_depth}
+
+
+def in_fresh_process(function, *args):
+    with multiprocessing.get_context('spawn').Pool(1) as pool:
+        return pool.apply(function, args)
+
+
+def benchmark(sizes=SIZES, steps=list(STEPS), work_dir='benchmark', orders_per_sku=50, **generate_options):
+    """Yields one measurement (dict) per size and step. `sizes` are numbers of customer orders."""
+    for size in sizes:
+        data_dir = f'{work_dir}/data_{size}'
+        database = f'{work_dir}/ledger_{size}.duckdb'
+        if os.path.exists(database):
+            os.remove(database)
+        generate(data_dir, n_skus=max(1, size // orders_per_sku), orders_per_sku=orders_per_sku, **generate_options)
+
+        yield {'size': size, 'step': 'ledger', **in_fresh_process(run_ledger, data_dir, database)}
+        for step in steps:
+            yield {'size': size, 'step': step, **in_fresh_process(run_step, step, database)}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time the analyses on synthetic data of increasing size.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES, help='numbers of customer orders, e.g. 10000 1000000 50000000')
+    parser.add_argument('--steps', nargs='+', default=list(STEPS), choices=list(STEPS))
+    parser.add_argument('--orders-per-sku', type=int, default=50)
+    parser.add_argument('--shortage-rate', type=float, default=0.2)
+    parser.add_argument('--waste-rate', type=float, default=0.2)
+    parser.add_argument('--work-dir', default='benchmark')
+    parser.add_argument('--output', default='benchmark/results.csv')
+    args = parser.parse_args()
+
+    os.makedirs(args.work_dir, exist_ok=True)
+    with open(args.output, 'w', newline='') as f:
+        writer = csv.DictWriter(f, ['size', 'step', 'rows', 'seconds', 'peak_rss_mb', 'recursion_depth'])
+        writer.writeheader()
+        for measurement in benchmark(args.sizes, args.steps, args.work_dir, args.orders_per_sku,
+                                     shortage_rate=args.shortage_rate, waste_rate=args.waste_rate):
+            writer.writerow(measurement)
+            f.flush()
+            print(measurement)
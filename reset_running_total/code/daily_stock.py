@@ -0,0 +1,107 @@
+import datetime
+
+import FIFO_stock_level_projections_numpy
+from ledger import open_ledger
+
+
+# Daily stock level series: one row per product and day, from the first to the last transaction date of the product
+# (days without transactions included), with the stock on hand at the end of the day and the quantities of the day.
+# The table is stored sorted by (product_code, date), so the min/max (zone map) of every row group is a narrow range:
+# point and date range lookups skip the row groups of all other products and dates instead of scanning transactions.
+# Transactions without a date are not in the series: expirations of batches and production orders of products that are
+# not in products.csv (no shelf life, so no expiration date). They sort after all dated transactions in the ledger, so
+# they do not change any day; only their waste is missing from the daily totals (it is in stock_levels).
+
+DAILY_STOCK = """
+create or replace table daily_stock as
+with end_of_day as (
+    -- running totals after the last transaction of every day
+    select
+        product_code,
+        transaction_date as date,
+        RT_produced,
+        RT_ordered,
+        RT_sold,
+        RT_missed_sales,
+        RT_waste,
+        stock
+    from
+        stock_levels
+    where
+        transaction_date is not null
+    qualify
+        row_number() over (partition by product_code, transaction_date order by sort_order desc, reference_number desc) = 1
+),
+days as (
+    select
+        product_code,
+        unnest(generate_series(min(date), max(date), interval 1 day))::date as date
+    from
+        end_of_day
+    group by
+        product_code
+),
+filled as (
+    -- days without transactions keep the running totals of the day before
+    select
+        days.product_code,
+        days.date,
+        last_value(end_of_day.RT_produced ignore nulls) over running_days as RT_produced,
+        last_value(end_of_day.RT_ordered ignore nulls) over running_days as RT_ordered,
+        last_value(end_of_day.RT_sold ignore nulls) over running_days as RT_sold,
+        last_value(end_of_day.RT_missed_sales ignore nulls) over running_days as RT_missed_sales,
+        last_value(end_of_day.RT_waste ignore nulls) over running_days as RT_waste,
+        last_value(end_of_day.stock ignore nulls) over running_days as stock
+    from
+        days
+        left join end_of_day
+            on end_of_day.product_code = days.product_code and end_of_day.date = days.date
+    window
+        running_days as (partition by days.product_code order by days.date)
+)
+
+select
+    product_code,
+    date,
+    stock,
+    RT_produced - coalesce(lag(RT_produced) over previous_day, 0) as produced_qty,
+    RT_ordered - coalesce(lag(RT_ordered) over previous_day, 0) as ordered_qty,
+    RT_sold - coalesce(lag(RT_sold) over previous_day, 0) as sold_qty,
+    RT_missed_sales - coalesce(lag(RT_missed_sales) over previous_day, 0) as missed_sales_qty,
+    RT_waste - coalesce(lag(RT_waste) over previous_day, 0) as waste_qty
+from
+    filled
+window
+    previous_day as (partition by product_code order by date)
+order by
+    product_code, date
+"""
+
+
+def build_daily_stock(con, stock_levels=None):
+    """(Re)build the daily_stock table from a stock_levels relation (default: the NumPy stock levels of the ledger).
+    Transactions without a transaction_date are left out, see above."""
+    if stock_levels is None:
+        stock_levels = FIFO_stock_level_projections_numpy.stock_levels(con)
+    con.execute(DAILY_STOCK)
+
+
+def stock_on(con, product_code, date):
+    """The daily_stock row of one product and day (a dict), None outside the dates of the product."""
+    relation = con.sql("select * from daily_stock where product_code = $product_code and date = $date",
+                       params={'product_code': product_code, 'date': date})
+    row = relation.fetchone()
+    return dict(zip(relation.columns, row)) if row else None
+
+
+def stock_between(con, product_code, start_date, end_date):
+    """The daily_stock rows of one product from `start_date` up to and including `end_date`, as a relation."""
+    return con.sql("select * from daily_stock where product_code = $product_code and date between $start_date and $end_date order by date",
+                   params={'product_code': product_code, 'start_date': start_date, 'end_date': end_date})
+
+
+if __name__ == '__main__':
+    con = open_ledger()
+    build_daily_stock(con)
+    print(stock_on(con, 'cupc01', datetime.date(2024, 8, 3)))
+    stock_between(con, 'cupc01', datetime.date(2024, 8, 1), datetime.date(2024, 8, 14)).show()
@@ -0,0 +1,60 @@
+import argparse
+import os
+
+import pyarrow.dataset
+
+import analyses
+import runtime
+
+
+# Export of the results as arrow record batches, or as parquet / arrow ipc files partitioned by product_code
+# (hive style: <output_dir>/<result>/product_code=<product_code>/...). The rows never become python objects:
+# parquet files are written by DuckDB itself, arrow files are written by pyarrow from DuckDB's record batch stream.
+
+BATCH_SIZE = 100_000
+
+RESULTS = {
+    'result1': analyses.result1,
+    'result2': analyses.result2,
+    'part1': analyses.part1,
+    'stock_levels': lambda con: analyses.stock_levels(con, latest_only=True),
+}
+
+FORMATS = ['parquet', 'arrow']
+
+
+def record_batches(con, result, batch_size=BATCH_SIZE):
+    """One of the RESULTS as a pyarrow RecordBatchReader: batches are produced while they are read."""
+    return RESULTS[result](con).to_arrow_reader(batch_size)
+
+
+def write(con, relation, path, file_format='parquet', batch_size=BATCH_SIZE):
+    """Write a relation to the directory `path`, partitioned by product_code."""
+    if file_format == 'parquet':
+        con.execute(f"copy (select * from relation) to '{path}' (format parquet, partition_by (product_code), overwrite)")
+    else:
+        pyarrow.dataset.write_dataset(
+            relation.to_arrow_reader(batch_size), path, format='ipc', partitioning=['product_code'], partitioning_flavor='hive',
+            existing_data_behavior='delete_matching',
+        )
+
+
+def export(con, result, output_dir='exports', file_format='parquet', batch_size=BATCH_SIZE):
+    """Write one of the RESULTS to `output_dir`/`result`, partitioned by product_code. Returns the directory."""
+    os.makedirs(output_dir, exist_ok=True)
+    path = f'{output_dir}/{result}'
+    write(con, RESULTS[result](con), path, file_format, batch_size)
+    return path
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export the results, partitioned by product_code.')
+    parser.add_argument('--results', nargs='+', default=list(RESULTS), choices=list(RESULTS))
+    parser.add_argument('--format', default='parquet', choices=FORMATS)
+    parser.add_argument('--output-dir', default='exports')
+    runtime.add_arguments(parser)
+    args = parser.parse_args()
+
+    con = runtime.connect_from_args(args)
+    for result in args.results:
+        print(export(con, result, args.output_dir, args.format))
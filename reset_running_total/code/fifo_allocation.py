@@ -0,0 +1,102 @@
+from collections import deque
+
+import pyarrow as pa
+
+from ledger import open_ledger
+
+
+# FIFO allocation of batches to customer orders: a single pass over the transactions of every product in the order of
+# the ledger. Stock batches and production orders join a queue of batches, customer orders take from the oldest batch
+# that still has stock, and expiring batches are wasted. Every transaction is handled in (amortized) constant time.
+# When batches expire in the order they arrive (as in the example data), the totals per order and per batch match
+# stock_levels. The lower bounds of stock_levels can differ when they hit the recursion safeguard, or when a younger
+# batch expires before an older one.
+
+LEDGER_TRANSACTIONS = """
+select product_code, reference_number, produced_qty, ordered_qty, transaction_date, sort_order
+from ledger
+order by product_code, transaction_date, sort_order, reference_number
+"""
+
+
+OPEN_BATCHES_SCHEMA = pa.schema([('product_code', pa.string()), ('batch_number', pa.string()), ('remaining_qty', pa.int64())])
+
+
+def allocate(transactions, open_batches=None):
+    """FIFO simulation over an arrow table of ledger transactions, sorted by product_code, transaction_date,
+    sort_order and reference_number.
+
+    `open_batches` (product_code, batch_number, remaining_qty), oldest batch first, are the batches that are
+    still in the queue before the first transaction (see snapshots.py).
+
+    Returns three arrow tables:
+    - allocations (product_code, customer_order_number, batch_number, qty): which batch (stock batch_number or
+      production_order_number) serves which customer order. The part of an order that can't be served is a row
+      without batch_number.
+    - waste (product_code, batch_number, expiration_date, waste_qty): what is left of every batch when it expires.
+    - open_batches: the batches with stock left after the last transaction, in the same format as the argument."""
+    allocations = {'product_code': [], 'customer_order_number': [], 'batch_number': [], 'qty': []}
+    waste = {'product_code': [], 'batch_number': [], 'expiration_date': [], 'waste_qty': []}
+    remaining_batches = {'product_code': [], 'batch_number': [], 'remaining_qty': []}
+
+    queues = {} # product_code: (batch numbers oldest first, {batch number: qty left in the batch})
+    for product_code, batch_number, remaining_qty in zip(*(open_batches or pa.table([[]] * 3, schema=OPEN_BATCHES_SCHEMA)).to_pydict().values()):
+        batches, remaining = queues.setdefault(product_code, (deque(), {}))
+        batches.append(batch_number)
+        remaining[batch_number] = remaining_qty
+
+    for product_code, reference_number, produced_qty, ordered_qty, transaction_date, sort_order in zip(
+        *(transactions[column].to_pylist() for column in ['product_code', 'reference_number', 'produced_qty', 'ordered_qty', 'transaction_date', 'sort_order'])
+    ):
+        batches, remaining = queues.setdefault(product_code, (deque(), {}))
+
+        if sort_order in (0, 1): # stock or production order
+            batches.append(reference_number)
+            remaining[reference_number] = produced_qty
+
+        elif sort_order == 2: # customer order
+            qty = ordered_qty
+            while qty > 0 and batches:
+                batch_number = batches[0]
+                taken = min(qty, remaining[batch_number])
+                if taken > 0:
+                    for column, value in zip(allocations, [product_code, reference_number, batch_number, taken]):
+                        allocations[column].append(value)
+                    remaining[batch_number] -= taken
+                    qty -= taken
+                if remaining[batch_number] == 0:
+                    batches.popleft()
+            if qty > 0:
+                for column, value in zip(allocations, [product_code, reference_number, None, qty]):
+                    allocations[column].append(value)
+
+        else: # expired stock or production order: the batch stays in the queue with nothing left
+            waste_qty = remaining.get(reference_number, 0)
+            remaining[reference_number] = 0
+            for column, value in zip(waste, [product_code, reference_number, transaction_date, waste_qty]):
+                waste[column].append(value)
+
+    for product_code, (batches, remaining) in sorted(queues.items()):
+        for batch_number in batches:
+            if remaining[batch_number] > 0:
+                for column, value in zip(remaining_batches, [product_code, batch_number, remaining[batch_number]]):
+                    remaining_batches[column].append(value)
+
+    return (
+        pa.table(allocations, schema=pa.schema([('product_code', pa.string()), ('customer_order_number', pa.string()), ('batch_number', pa.string()), ('qty', pa.int64())])),
+        pa.table(waste, schema=pa.schema([('product_code', pa.string()), ('batch_number', pa.string()), ('expiration_date', pa.date32()), ('waste_qty', pa.int64())])),
+        pa.table(remaining_batches, schema=OPEN_BATCHES_SCHEMA),
+    )
+
+
+def fifo_allocation(con):
+    """Returns the allocations and the waste per batch (see allocate) as relations."""
+    allocations, waste, _ = allocate(con.sql(LEDGER_TRANSACTIONS).to_arrow_table())
+    return con.from_arrow(allocations), con.from_arrow(waste)
+
+
+if __name__ == '__main__':
+    con = open_ledger()
+    allocations, waste = fifo_allocation(con)
+    con.sql("select * from allocations where product_code = 'cupc01'").show()
+    con.sql("select * from waste where product_code = 'cupc01'").show()
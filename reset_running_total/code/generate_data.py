@@ -0,0 +1,102 @@
+import argparse
+import os
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv
+
+
+# Seeded generator of synthetic customer_orders, production_orders, products and stock csv files,
+# with the same columns as the files in reset_running_total/data.
+
+START_DATE = np.datetime64('2024-07-01')
+
+
+def reference_numbers(prefix, n):
+    return pc.binary_join_element_wise(prefix, pc.cast(pa.array(np.arange(n)), pa.string()), '')
+
+
+def dates(days):
+    return pa.array((START_DATE + days.astype('timedelta64[D]')).astype('datetime64[D]'))
+
+
+def generate(output_dir, n_skus=1000, orders_per_sku=50, horizon_days=90, min_shelf_life_days=3, max_shelf_life_days=21,
+             shortage_rate=0.2, waste_rate=0.2, seed=0):
+    """Write the four csv files to `output_dir`.
+
+    Delivery dates are spread uniformly over the horizon. Every product gets a supply (stock + production orders) that matches
+    its demand, except for a `shortage_rate` share of the products that only get 70% of it and a `waste_rate` share
+    of the products that get 150% of it."""
+    rng = np.random.default_rng(seed)
+    os.makedirs(output_dir, exist_ok=True)
+    product_codes = reference_numbers('p', n_skus)
+
+    shelf_life_days = rng.integers(min_shelf_life_days, max_shelf_life_days + 1, n_skus)
+    products = pa.table({
+        'product_code': product_codes,
+        'description': pc.binary_join_element_wise('product ', product_codes, ''),
+        'shelf_life_days': shelf_life_days,
+    })
+
+    # customer orders
+    n_orders = n_skus * orders_per_sku
+    order_products = np.repeat(np.arange(n_skus), orders_per_sku)
+    order_qty = rng.integers(1, 25, n_orders)
+    customer_orders = pa.table({
+        'product_code': product_codes.take(pa.array(order_products)),
+        'customer_order_number': reference_numbers('c#', n_orders),
+        'qty': order_qty,
+        'delivery_date': dates(rng.integers(0, horizon_days, n_orders)),
+    })
+
+    # supply per product: demand times 0.7 (shortage), 1.5 (waste) or 1.0
+    demand = np.bincount(order_products, weights=order_qty, minlength=n_skus)
+    supply_factor = rng.choice([0.7, 1.5, 1.0], n_skus, p=[shortage_rate, waste_rate, 1 - shortage_rate - waste_rate])
+    supply = np.maximum(1, np.round(demand * supply_factor)).astype(np.int64)
+
+    # 10% of the supply is stock, produced up to a week before the start of the horizon
+    stock_qty = np.maximum(1, supply // 10)
+    stock_production_days = rng.integers(-7, 0, n_skus)
+    stock = pa.table({
+        'product_code': product_codes,
+        'batch_number': reference_numbers('B', n_skus),
+        'qty': stock_qty,
+        'production_date': dates(stock_production_days),
+        'expiration_date': dates(stock_production_days + shelf_life_days),
+    })
+
+    # the rest is split in production orders of about 5 customer orders each
+    orders_per_production = 5
+    n_productions_per_sku = max(1, orders_per_sku // orders_per_production)
+    production_products = np.repeat(np.arange(n_skus), n_productions_per_sku)
+    production_qty = np.maximum(1, (supply - stock_qty) // n_productions_per_sku)[production_products]
+    n_productions = len(production_products)
+    production_orders = pa.table({
+        'product_code': product_codes.take(pa.array(production_products)),
+        'production_order_number': reference_numbers('po#', n_productions),
+        'qty': production_qty,
+        'production_date': dates(rng.integers(-3, horizon_days - 3, n_productions)),
+    })
+
+    for name, table in [('customer_orders', customer_orders), ('production_orders', production_orders), ('products', products), ('stock', stock)]:
+        with open(f'{output_dir}/{name}.csv', 'wb') as f:
+            f.write((','.join(table.column_names) + '\n').encode())
+            pyarrow.csv.write_csv(table, f, pyarrow.csv.WriteOptions(include_header=False, quoting_style='none'))
+    return {'customer_orders': n_orders, 'production_orders': n_productions, 'products': n_skus, 'stock': n_skus}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate synthetic input csv files.')
+    parser.add_argument('output_dir')
+    parser.add_argument('--skus', type=int, default=1000)
+    parser.add_argument('--orders-per-sku', type=int, default=50)
+    parser.add_argument('--horizon-days', type=int, default=90)
+    parser.add_argument('--min-shelf-life-days', type=int, default=3)
+    parser.add_argument('--max-shelf-life-days', type=int, default=21)
+    parser.add_argument('--shortage-rate', type=float, default=0.2)
+    parser.add_argument('--waste-rate', type=float, default=0.2)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    print(generate(args.output_dir, args.skus, args.orders_per_sku, args.horizon_days, args.min_shelf_life_days,
+                   args.max_shelf_life_days, args.shortage_rate, args.waste_rate, args.seed))
@@ -0,0 +1,191 @@
+import duckdb # documentation available on https://duckdb.org/docs/api/python/overview
+
+import FIFO_stock_level_projections_numpy
+import reset_running_total_numpy
+from ledger import LEDGER_DATABASE, TRANSACTIONS, build_ledger, ledger_is_current, save_source_hashes, update_compact_ledger
+from tables import DATA_DIR, load_tables
+
+
+# Incremental mode: result1, result2 and stock_levels are checkpointed in the ledger database. When the csv files change,
+# only the products with new, changed or removed transactions are recalculated, starting from their earliest changed
+# transaction_date. Earlier transactions keep their checkpointed running totals and lower bounds, which are carried into
+# the recalculation. (The lower bounds of a transaction only depend on the transactions before it.)
+
+CHECKPOINTS = ['checkpoint_result1', 'checkpoint_result2', 'checkpoint_stock_levels']
+
+BASE_COLUMNS = 'product_code, reference_number, produced_qty, ordered_qty, potential_waste_qty, transaction_date, sort_order'
+
+# Transactions from this date onward (and transactions without a date, which sort last) are recalculated.
+# A product without cut_date only has changes in transactions without a date and is recalculated completely.
+IN_RECALCULATION = "(({table}.transaction_date >= changed_products.cut_date) or {table}.transaction_date is null or changed_products.cut_date is null)"
+
+CHANGED_PRODUCTS = f"""
+create or replace temp table changed_products as
+with changes as (
+    (select {BASE_COLUMNS} from source_transactions except all select {BASE_COLUMNS} from ledger)
+    union all
+    (select {BASE_COLUMNS} from ledger except all select {BASE_COLUMNS} from source_transactions)
+)
+select
+    product_code,
+    min(transaction_date) as cut_date
+from
+    changes
+group by
+    product_code
+"""
+
+# Running totals of the transactions before the cut. The cut always falls between two dates, so these are also
+# the running_total_v1 of questions 1 and 2 on the last day before the cut.
+LEDGER_CARRY = """
+create or replace temp table ledger_carry as
+select
+    changed_products.product_code,
+    coalesce(sum(ledger.produced_qty), 0) as RT_produced,
+    coalesce(sum(ledger.ordered_qty), 0) as RT_ordered,
+    coalesce(sum(ledger.potential_waste_qty), 0) as RT_potential_waste
+from
+    changed_products
+    left join ledger
+        on ledger.product_code = changed_products.product_code
+        and ledger.transaction_date < changed_products.cut_date
+group by
+    changed_products.product_code
+"""
+
+UPDATE_LEDGER = f"""
+insert into ledger
+select
+    t.*,
+    c.RT_produced + sum(t.produced_qty) over (partition by t.product_code order by t.transaction_date, t.sort_order, t.reference_number) as RT_produced,
+    c.RT_ordered + sum(t.ordered_qty) over (partition by t.product_code order by t.transaction_date, t.sort_order, t.reference_number) as RT_ordered,
+    c.RT_potential_waste + sum(t.potential_waste_qty) over (partition by t.product_code order by t.transaction_date, t.sort_order, t.reference_number) as RT_potential_waste,
+    c.RT_produced - c.RT_ordered + sum(t.produced_qty - t.ordered_qty) over (partition by t.product_code order by t.transaction_date, t.sort_order >= 2) as fill_running_total,
+    c.RT_ordered - c.RT_potential_waste + sum(t.ordered_qty - t.potential_waste_qty) over (partition by t.product_code order by t.transaction_date, t.sort_order >= 3) as expiry_running_total
+from
+    source_transactions as t
+    inner join changed_products
+        on t.product_code = changed_products.product_code
+    inner join ledger_carry as c
+        on t.product_code = c.product_code
+where
+    {IN_RECALCULATION.format(table='t')}
+order by
+    t.product_code, t.transaction_date, t.sort_order, t.reference_number
+"""
+
+RESET_RUNNING_TOTAL_CARRY = f"""
+select
+    t.product_code,
+    t.reference_number,
+    t.qty,
+    t.transaction_date,
+    t.sort_order,
+    {{carry_running_total_v1}} as carry_running_total_v1,
+    (
+        select min(checkpoint.running_total_v1)
+        from {{checkpoint}} as checkpoint
+        where checkpoint.product_code = t.product_code and checkpoint.transaction_date < changed_products.cut_date
+    ) as carry_min_running_total_v1
+from
+    {{transactions}} as t
+    inner join changed_products
+        on t.product_code = changed_products.product_code
+    inner join ledger_carry as c
+        on t.product_code = c.product_code
+where
+    {IN_RECALCULATION.format(table='t')}
+"""
+
+STOCK_LEVELS_CARRY = f"""
+with carry as (
+    select
+        changed_products.product_code,
+        min(checkpoint.RT_produced - checkpoint.RT_waste - checkpoint.RT_ordered) as carry_min_missed_sales,
+        min(checkpoint.RT_ordered - checkpoint.RT_missed_sales - checkpoint.RT_potential_waste) as carry_min_waste,
+        max(checkpoint.RT_missed_sales) as carry_RT_missed_sales, -- lower bounds never go down, so this is the last one
+        max(checkpoint.RT_waste) as carry_RT_waste
+    from
+        changed_products
+        left join checkpoint_stock_levels as checkpoint
+            on checkpoint.product_code = changed_products.product_code
+            and checkpoint.transaction_date < changed_products.cut_date
+    group by
+        changed_products.product_code
+)
+select
+    t.*,
+    carry.carry_min_missed_sales,
+    carry.carry_min_waste,
+    carry.carry_RT_missed_sales,
+    carry.carry_RT_waste
+from
+    fifo_transactions as t
+    inner join changed_products
+        on t.product_code = changed_products.product_code
+    inner join carry
+        on t.product_code = carry.product_code
+where
+    {IN_RECALCULATION.format(table='t')}
+"""
+
+
+def build_checkpoints(con):
+    """Calculate result1, result2 and stock_levels for all products."""
+    result1 = reset_running_total_numpy.result1(con)
+    result2 = reset_running_total_numpy.result2(con)
+    stock_levels = FIFO_stock_level_projections_numpy.stock_levels(con)
+    con.execute("create or replace table checkpoint_result1 as select * from result1")
+    con.execute("create or replace table checkpoint_result2 as select * from result2")
+    con.execute("create or replace table checkpoint_stock_levels as select * from stock_levels")
+
+
+def delete_recalculated_rows(con, table):
+    con.execute(f"""
+        delete from {table}
+        using changed_products
+        where {table}.product_code = changed_products.product_code and {IN_RECALCULATION.format(table=table)}
+    """)
+
+
+def update_checkpoints(con):
+    """Recalculate the rows of the changed products from their cut date onward, from the updated ledger."""
+    result1 = reset_running_total_numpy.reset_running_total(con, RESET_RUNNING_TOTAL_CARRY.format(
+        transactions='fill_transactions', checkpoint='checkpoint_result1', carry_running_total_v1='c.RT_produced - c.RT_ordered'))
+    result2 = reset_running_total_numpy.reset_running_total(con, RESET_RUNNING_TOTAL_CARRY.format(
+        transactions='expiry_transactions', checkpoint='checkpoint_result2', carry_running_total_v1='c.RT_ordered - c.RT_potential_waste'))
+    stock_levels = FIFO_stock_level_projections_numpy.stock_levels(con, STOCK_LEVELS_CARRY)
+    for table, new_rows in [('checkpoint_result1', result1), ('checkpoint_result2', result2), ('checkpoint_stock_levels', stock_levels)]:
+        delete_recalculated_rows(con, table)
+        con.execute(f"insert into {table} select * from new_rows")
+
+
+def refresh(con, data_dir=DATA_DIR):
+    """Bring the ledger and the checkpoints in line with the csv files.
+    Returns the product codes that were recalculated (None after a full build)."""
+    hashes = load_tables(con, data_dir)
+    has_checkpoints = con.sql(f"select count(*) from duckdb_tables() where table_name in {tuple(CHECKPOINTS)}").fetchone()[0] == len(CHECKPOINTS)
+    if not has_checkpoints:
+        build_ledger(con, data_dir, hashes)
+        build_checkpoints(con)
+        return None
+    if ledger_is_current(con, hashes):
+        return []
+
+    con.execute(TRANSACTIONS)
+    con.execute(CHANGED_PRODUCTS)
+    con.execute(LEDGER_CARRY)
+
+    # the ledger first gets its new transactions, the checkpoints read from it (and from their own earlier rows)
+    delete_recalculated_rows(con, 'ledger')
+    con.execute(UPDATE_LEDGER)
+    update_compact_ledger(con, "product_code in (select product_code from changed_products)")
+    update_checkpoints(con)
+    save_source_hashes(con, hashes)
+    return [product_code for product_code, in con.sql("select product_code from changed_products order by product_code").fetchall()]
+
+
+if __name__ == '__main__':
+    con = duckdb.connect(LEDGER_DATABASE)
+    print('recalculated products:', refresh(con))
+    con.sql("select * from checkpoint_stock_levels where product_code = 'cupc01' order by transaction_date, sort_order, reference_number").show()
@@ -0,0 +1,278 @@
+import duckdb # documentation available on https://duckdb.org/docs/api/python/overview
+
+from tables import DATA_DIR, load_tables
+
+
+# All analyses read their transactions from one ledger table. It is stored in a DuckDB database file (together with
+# the loaded input tables) and only rebuilt when one of the csv files changed, so the inputs are scanned and sorted
+# once per data load.
+
+LEDGER_DATABASE = 'reset_running_total/ledger.duckdb'
+
+# sort_order: 0 = stock, 1 = production order, 2 = customer order, 3 = expired stock, 4 = expired production order
+# reference_number is stored without the 'WASTE ' prefix: the prefix is the same for all rows with the same
+# sort_order, so it never changes the order of the transactions.
+# `key` holds extra leading key columns of the input tables (e.g. 'scenario_id, ' in scenarios.py).
+SOURCE_TRANSACTIONS = """
+create or replace view {view} as
+with stock_transactions as (
+    select
+        {key}product_code,
+        batch_number as reference_number,
+        qty as produced_qty,
+        0 as ordered_qty,
+        0 as potential_waste_qty,
+        production_date as transaction_date,
+        0 as sort_order
+    from
+        {stock}
+),
+production_transactions as (
+    select
+        {key}product_code,
+        production_order_number as reference_number,
+        qty as produced_qty,
+        0 as ordered_qty,
+        0 as potential_waste_qty,
+        production_date as transaction_date,
+        1 as sort_order
+    from
+        {production_orders}
+),
+customer_transactions as (
+    select
+        {key}product_code,
+        customer_order_number as reference_number,
+        0 as produced_qty,
+        qty as ordered_qty,
+        0 as potential_waste_qty,
+        delivery_date as transaction_date,
+        2 as sort_order
+    from
+        {customer_orders}
+),
+expired_stock_transactions as (
+    select
+        {key}product_code,
+        batch_number as reference_number,
+        0 as produced_qty,
+        0 as ordered_qty,
+        qty as potential_waste_qty,
+        expiration_date as transaction_date,
+        3 as sort_order
+    from
+        {stock}
+),
+expired_production_transactions as (
+    select
+        {key}po.product_code,
+        po.production_order_number as reference_number,
+        0 as produced_qty,
+        0 as ordered_qty,
+        po.qty as potential_waste_qty,
+        po.production_date + p.shelf_life_days::int as transaction_date,
+        4 as sort_order
+    from
+        {production_orders} as po
+        left join {products} as p
+            using ({key}product_code)
+),
+transactions as (
+    select * from stock_transactions
+    union all
+    select * from production_transactions
+    union all
+    select * from customer_transactions
+    union all
+    select * from expired_stock_transactions
+    union all
+    select * from expired_production_transactions
+)
+
+select * from transactions
+"""
+
+TRANSACTIONS = SOURCE_TRANSACTIONS.format(view='source_transactions', key='', stock='stock', production_orders='production_orders',
+                                          customer_orders='customer_orders', products='products')
+
+LEDGER = """
+create or replace table ledger as
+select
+    *,
+    -- FIFO stock level projections
+    -- (sums of bigint are hugeint, which reach arrow/NumPy as decimals: the running totals are stored as bigint)
+    (sum(produced_qty) over (partition by product_code order by transaction_date, sort_order, reference_number))::bigint as RT_produced,
+    (sum(ordered_qty) over (partition by product_code order by transaction_date, sort_order, reference_number))::bigint as RT_ordered,
+    (sum(potential_waste_qty) over (partition by product_code order by transaction_date, sort_order, reference_number))::bigint as RT_potential_waste,
+    -- running_total_v1 of question 1 (production before orders) and question 2 (orders before expiration)
+    (sum(produced_qty - ordered_qty) over (partition by product_code order by transaction_date, sort_order >= 2))::bigint as fill_running_total,
+    (sum(ordered_qty - potential_waste_qty) over (partition by product_code order by transaction_date, sort_order >= 3))::bigint as expiry_running_total
+from
+    source_transactions
+order by
+    product_code, transaction_date, sort_order, reference_number
+"""
+
+# Transactions of question 1: can we fill the orders?
+FILL_TRANSACTIONS = """
+create or replace view fill_transactions as
+select
+    product_code,
+    reference_number,
+    produced_qty - ordered_qty as qty,
+    transaction_date,
+    (sort_order = 2)::int as sort_order,
+    fill_running_total as running_total_v1
+from
+    ledger
+where
+    sort_order in (0, 1, 2)
+"""
+
+# Transactions of question 2: will it expire?
+EXPIRY_TRANSACTIONS = """
+create or replace view expiry_transactions as
+select
+    product_code,
+    reference_number,
+    ordered_qty - potential_waste_qty as qty,
+    transaction_date,
+    (sort_order in (3, 4))::int as sort_order,
+    expiry_running_total as running_total_v1
+from
+    ledger
+where
+    sort_order in (2, 3, 4)
+"""
+
+# transactions_with_running_totals of the FIFO stock level projections
+FIFO_TRANSACTIONS = """
+create or replace view fifo_transactions as
+select
+    product_code,
+    case when sort_order >= 3 then concat('WASTE ', reference_number) else reference_number end as reference_number,
+    produced_qty,
+    ordered_qty,
+    potential_waste_qty,
+    transaction_date,
+    sort_order,
+    RT_produced,
+    RT_ordered,
+    RT_potential_waste
+from
+    ledger
+"""
+
+
+# Compact copy of the ledger: product_code and reference_number are dictionary encoded (ids are assigned in order of
+# arrival, so they do not sort like the strings), dates are int32 day numbers (days since 1970-01-01, the same
+# representation as an arrow date32) and quantities are int32. `ordinal` numbers the transactions of a product in the
+# order of (transaction_date, sort_order, reference_number), with the same ordinal for peers, so (product_id, ordinal)
+# replaces the composite sort key and sorting only compares integers.
+COMPACT_LEDGER_TABLES = """
+create table if not exists product_dictionary (product_id integer primary key, product_code varchar unique);
+create table if not exists reference_dictionary (reference_id integer primary key, reference_number varchar unique);
+create table if not exists compact_ledger (
+    product_id integer,
+    reference_id integer,
+    day integer,
+    sort_order utinyint,
+    ordinal integer,
+    produced_qty integer,
+    ordered_qty integer,
+    potential_waste_qty integer,
+    RT_produced bigint,
+    RT_ordered bigint,
+    RT_potential_waste bigint,
+    fill_running_total bigint,
+    expiry_running_total bigint
+);
+"""
+
+ADD_TO_DICTIONARY = """
+insert into {name}_dictionary
+select
+    (select coalesce(max({name}_id) + 1, 0) from {name}_dictionary) + row_number() over (order by {column}) - 1,
+    {column}
+from
+    (select distinct {column} from ledger where {products}) as new_values
+    anti join {name}_dictionary using ({column})
+"""
+
+COMPACT_LEDGER = """
+insert into compact_ledger
+select
+    p.product_id,
+    r.reference_id,
+    (ledger.transaction_date - date '1970-01-01')::integer as day,
+    ledger.sort_order::utinyint,
+    dense_rank() over (partition by ledger.product_code order by ledger.transaction_date, ledger.sort_order, ledger.reference_number)::integer as ordinal,
+    ledger.produced_qty::integer,
+    ledger.ordered_qty::integer,
+    ledger.potential_waste_qty::integer,
+    ledger.RT_produced,
+    ledger.RT_ordered,
+    ledger.RT_potential_waste,
+    ledger.fill_running_total,
+    ledger.expiry_running_total
+from
+    (select * from ledger where {products}) as ledger
+    inner join product_dictionary as p
+        on p.product_code = ledger.product_code
+    inner join reference_dictionary as r
+        on r.reference_number = ledger.reference_number
+order by
+    p.product_id, ordinal
+"""
+
+
+def update_compact_ledger(con, products='true'):
+    """(Re)build the rows of the compact ledger for the products that match the `products` condition on product_code."""
+    con.execute(COMPACT_LEDGER_TABLES)
+    con.execute(ADD_TO_DICTIONARY.format(name='product', column='product_code', products=products))
+    con.execute(ADD_TO_DICTIONARY.format(name='reference', column='reference_number', products=products))
+    con.execute(f"delete from compact_ledger where product_id in (select product_id from product_dictionary where {products})")
+    con.execute(COMPACT_LEDGER.format(products=products))
+
+
+def ledger_is_current(con, hashes):
+    """True if the ledger in `con` was built from csv files with these hashes."""
+    if con.sql("select count(*) from duckdb_tables() where table_name = 'ledger_sources'").fetchone()[0] == 0:
+        return False
+    return dict(con.sql("select table_name, sha256 from ledger_sources").fetchall()) == hashes
+
+
+def save_source_hashes(con, hashes):
+    con.execute("create or replace table ledger_sources (table_name varchar, sha256 varchar)")
+    con.executemany("insert into ledger_sources values (?, ?)", list(hashes.items()))
+
+
+def build_ledger(con, data_dir=DATA_DIR, hashes=None):
+    """(Re)build the ledger table and the views on top of it.
+    `hashes` are the hashes returned by load_tables, if the tables were already loaded."""
+    if hashes is None:
+        hashes = load_tables(con, data_dir)
+    con.execute(TRANSACTIONS)
+    con.execute(LEDGER)
+    con.execute(FILL_TRANSACTIONS)
+    con.execute(EXPIRY_TRANSACTIONS)
+    con.execute(FIFO_TRANSACTIONS)
+    con.execute("drop table if exists compact_ledger")
+    update_compact_ledger(con)
+    save_source_hashes(con, hashes)
+    return con
+
+
+def open_ledger(data_dir=DATA_DIR, database=LEDGER_DATABASE, config=None):
+    """Connect to the ledger database, rebuilding the ledger only if one of the csv files changed.
+    `config` holds DuckDB settings for the connection (see runtime.py)."""
+    con = duckdb.connect(database, config=config or {})
+    hashes = load_tables(con, data_dir)
+    if not ledger_is_current(con, hashes):
+        build_ledger(con, data_dir, hashes)
+    return con
+
+
+if __name__ == '__main__':
+    con = open_ledger()
+    con.sql("select * from ledger where product_code = 'cupc01' order by transaction_date, sort_order, reference_number").show()
@@ -0,0 +1,102 @@
+import argparse
+import time
+
+import analyses
+import runtime
+
+
+# Execute-once pipeline: a lazy relation runs its whole query (including every upstream relation it refers to) each time
+# it is read. The pipeline runs every stage exactly once into a temp table (or an arrow table registered under the
+# stage name), so later stages and repeated lookups read the materialized result. Intermediate stages are dropped as
+# soon as all stages that depend on them are materialized, unless they were asked for as an output.
+
+
+def fifo_stages(latest_only=True):
+    """Stages of the analyses: {name: (function(con) -> relation, [names of the stages it reads])}."""
+    return {
+        'result1': (analyses.result1, []),
+        'result2': (analyses.result2, []),
+        'part1': (analyses.part1, []),
+        # the latest only recursion starts from part 1, the full history starts from the transactions
+        'recursive_lower_bounds': (lambda con: analyses.recursive_lower_bounds(con, latest_only, part1='part1' if latest_only else None),
+                                   ['part1'] if latest_only else []),
+        'stock_levels': (lambda con: analyses.stock_levels(con, latest_only, lower_bounds='recursive_lower_bounds'), ['recursive_lower_bounds']),
+    }
+
+
+class Pipeline:
+    def __init__(self, con, stages, outputs=None, storage='table'):
+        """`outputs` are the stages that are kept until they are released (default: all stages).
+        `storage` is 'table' (temp tables, can spill to disk) or 'arrow' (arrow tables in python memory)."""
+        self.con = con
+        self.stages = stages
+        self.outputs = set(stages if outputs is None else outputs)
+        self.storage = storage
+        self.materialized = {} # stage: arrow table, or None for a temp table
+        self.log = [] # one entry per computed, reused or freed stage
+
+    def consumers(self, stage):
+        return [name for name, (_, dependencies) in self.stages.items() if stage in dependencies]
+
+    def get(self, stage):
+        """The result of a stage as a relation, computed the first time only."""
+        if stage in self.materialized:
+            self.log.append({'stage': stage, 'action': 'reused'})
+        else:
+            self.materialize(stage)
+        if self.storage == 'arrow':
+            return self.con.from_arrow(self.materialized[stage])
+        return self.con.table(stage)
+
+    def materialize(self, stage):
+        function, dependencies = self.stages[stage]
+        for dependency in dependencies:
+            if dependency not in self.materialized:
+                self.materialize(dependency)
+
+        start = time.perf_counter()
+        relation = function(self.con)
+        if self.storage == 'arrow':
+            self.materialized[stage] = relation.to_arrow_table()
+            self.con.register(stage, self.materialized[stage])
+            rows = self.materialized[stage].num_rows
+        else:
+            self.con.execute(f"create or replace temp table {stage} as select * from relation")
+            self.materialized[stage] = None
+            rows = self.con.sql(f"select count(*) from {stage}").fetchone()[0]
+        self.log.append({'stage': stage, 'action': 'computed', 'seconds': time.perf_counter() - start, 'rows': rows})
+
+        # free the dependencies that are no longer needed
+        for dependency in dependencies:
+            if dependency not in self.outputs and all(consumer in self.materialized for consumer in self.consumers(dependency)):
+                self.release(dependency)
+
+    def release(self, stage):
+        """Free the materialized result of a stage. It is computed again if it is asked for later."""
+        if stage not in self.materialized:
+            return
+        if self.storage == 'arrow':
+            self.con.unregister(stage)
+        else:
+            self.con.execute(f"drop table {stage}")
+        del self.materialized[stage]
+        self.log.append({'stage': stage, 'action': 'freed'})
+
+    def report(self):
+        """Number of times every stage was computed, reused and freed."""
+        report = {stage: {'computed': 0, 'reused': 0, 'freed': 0} for stage in self.stages}
+        for entry in self.log:
+            report[entry['stage']][entry['action']] += 1
+        return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the stock levels once and look up products in the materialized result.')
+    runtime.add_arguments(parser)
+    con = runtime.connect_from_args(parser.parse_args())
+    pipeline = Pipeline(con, fifo_stages(), outputs=['stock_levels'])
+
+    # the recursion runs once, every lookup reads the materialized stock levels
+    for product_code in ['cupc01', 'cook02']:
+        pipeline.get('stock_levels').filter(f"product_code = '{product_code}'").order('transaction_date, sort_order, reference_number').show()
+    print(pipeline.report())
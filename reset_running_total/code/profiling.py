@@ -0,0 +1,146 @@
+import argparse
+import json
+import tempfile
+import threading
+import time
+
+import analyses
+import runtime
+
+
+# Instrumentation of the FIFO stock level projections: timings and row counts per stage and per operator
+# (from DuckDB's json profiling output), plus the recursion depth every product needed to converge.
+# DuckDB's own peak memory and temp directory size are peaks since the connection was opened, so the memory and temp
+# storage of every stage are sampled (duckdb_memory()) on a separate cursor while the stage runs.
+
+STAGES = ['part1', 'recursive_lower_bounds', 'stock_levels']
+
+SAMPLE_INTERVAL = 0.01 # seconds
+
+MEMORY = "select sum(memory_usage_bytes), sum(temporary_storage_bytes) from duckdb_memory()"
+
+
+class ResourceSampler:
+    """Samples the buffer memory and the temp storage (data spilled to disk) of the database of `con` in a thread,
+    from entering until leaving the context."""
+
+    def __init__(self, con, interval=SAMPLE_INTERVAL):
+        self.cursor = con.cursor()
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.sample)
+
+    def sample(self):
+        while True:
+            memory, temp_storage = self.cursor.sql(MEMORY).fetchone()
+            self.peak_memory = max(self.peak_memory, memory)
+            self.peak_temp_storage = max(self.peak_temp_storage, temp_storage)
+            if self.stopped.wait(self.interval):
+                return
+
+    def __enter__(self):
+        self.start_memory, self.start_temp_storage = self.cursor.sql(MEMORY).fetchone()
+        self.peak_memory, self.peak_temp_storage = self.start_memory, self.start_temp_storage
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.thread.join()
+        self.cursor.close()
+
+
+def operators(node):
+    """Flatten the operator tree of a DuckDB json profile."""
+    for child in node.get('children', []):
+        yield {
+            'operator': child['operator_name'],
+            'seconds': child['operator_timing'],
+            'rows': child['operator_cardinality'],
+            'extra_info': child.get('extra_info', {}),
+        }
+        yield from operators(child)
+
+
+def profile_stage(con, stage, relation, profile_dir):
+    """Materialize `relation` into a table called `stage` with profiling enabled."""
+    profile_path = f'{profile_dir}/{stage}.json'
+    con.execute("set enable_profiling = 'json'")
+    con.execute(f"set profiling_output = '{profile_path}'")
+    with ResourceSampler(con) as resources:
+        start = time.perf_counter()
+        relation.to_table(stage)
+        seconds = time.perf_counter() - start
+    con.execute("set enable_profiling = 'no_output'")
+    with open(profile_path) as f:
+        profile = json.load(f)
+    return {
+        'stage': stage,
+        'seconds': seconds,
+        'rows': con.sql(f"select count(*) from {stage}").fetchone()[0],
+        'peak_buffer_memory': resources.peak_memory,
+        'temp_storage_before': resources.start_temp_storage,
+        'peak_temp_storage': resources.peak_temp_storage,
+        'operators': sorted(operators(profile), key=lambda operator: -operator['seconds']),
+    }
+
+
+def convergence(con):
+    """Recursion depth per product and the number of products still iterating at every depth."""
+    product_depths = con.sql("""
+        select product_code, max(recursion_depth) as recursion_depth
+        from recursive_lower_bounds
+        group by product_code
+        order by recursion_depth desc, product_code
+    """).fetchall()
+    active_products = con.sql("""
+        with product_depths as (
+            select product_code, max(recursion_depth) as recursion_depth
+            from recursive_lower_bounds
+            group by product_code
+        ),
+        depths as (
+            select unnest(range(0, (select max(recursion_depth) from product_depths) + 1)) as recursion_depth
+        )
+        select depths.recursion_depth, count(product_depths.product_code) as active_products
+        from depths left join product_depths on product_depths.recursion_depth >= depths.recursion_depth
+        group by depths.recursion_depth
+        order by depths.recursion_depth
+    """).fetchall()
+    return {
+        'max_recursion_depth': product_depths[0][1] if product_depths else None,
+        'active_products_per_depth': {depth: n for depth, n in active_products},
+        'products_at_safeguard': [product_code for product_code, depth in product_depths if depth + 1 >= 10],
+        'product_depths': {product_code: depth for product_code, depth in product_depths},
+    }
+
+
+def profile(con, latest_only=False, report_path=None):
+    """Run part 1, the recursive lower bounds and the stock levels one after the other, each materialized into a
+    (temporary) table of the same name. Returns the report and writes it as json to `report_path`, if given."""
+    with tempfile.TemporaryDirectory() as profile_dir:
+        stages = [
+            profile_stage(con, 'part1', analyses.part1(con), profile_dir),
+            profile_stage(con, 'recursive_lower_bounds', analyses.recursive_lower_bounds(con, latest_only, part1='part1' if latest_only else None), profile_dir),
+            profile_stage(con, 'stock_levels', analyses.stock_levels(con, latest_only, lower_bounds='recursive_lower_bounds'), profile_dir),
+        ]
+    report = {'latest_only': latest_only, 'stages': stages, 'convergence': convergence(con)}
+    if report_path:
+        with open(report_path, 'w') as f:
+            json.dump(report, f, indent=2, default=str)
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Profile the FIFO stock level projections.')
+    runtime.add_arguments(parser)
+    parser.add_argument('--latest-only', action='store_true')
+    parser.add_argument('--output', default='profile.json')
+    args = parser.parse_args()
+
+    # the stage tables go into an in-memory database, on top of the (read only) ledger
+    con = runtime.connect_from_args(args)
+    report = profile(con, args.latest_only, args.output)
+    for stage in report['stages']:
+        print(f"{stage['stage']}: {stage['seconds']:.3f}s, {stage['rows']} rows, slowest operator {stage['operators'][0]['operator']}")
+    print('active products per recursion depth:', report['convergence']['active_products_per_depth'])
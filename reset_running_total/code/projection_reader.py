@@ -0,0 +1,55 @@
+import sys
+import time
+
+import pyarrow as pa
+
+
+# Reader of the projection store written by projection_store.py. Only needs pyarrow: the file is memory mapped, so
+# a product's rows are record batch slices that point into the page cache (shared by all reader processes), nothing
+# is parsed or copied. Numeric columns without nulls can be viewed as NumPy arrays with `column.to_numpy()`.
+
+INDEX_KEY = b'product_index' # see projection_store.py
+
+
+class ProjectionReader:
+    def __init__(self, result, store_dir='exports/projections'):
+        self.source = pa.memory_map(f'{store_dir}/{result}.arrow')
+        self.reader = pa.ipc.open_file(self.source)
+        index = pa.ipc.open_stream(self.reader.schema.metadata[INDEX_KEY]).read_all()
+        self.index = dict(zip(
+            index['product_code'].to_pylist(),
+            zip(index['batch'].to_pylist(), index['row_offset'].to_pylist(), index['row_count'].to_pylist()),
+        ))
+        self.batches = {} # batch number: record batch, read on first use
+        self.schema = self.reader.schema
+
+    def product_codes(self):
+        return list(self.index)
+
+    def read(self, product_code):
+        """The rows of one product as a record batch, None if the product is not in the store."""
+        if product_code not in self.index:
+            return None
+        batch, row_offset, row_count = self.index[product_code]
+        if batch not in self.batches:
+            self.batches[batch] = self.reader.get_batch(batch)
+        return self.batches[batch].slice(row_offset, row_count)
+
+    def read_many(self, product_codes):
+        """The rows of several products as a table (one chunk per product)."""
+        return pa.Table.from_batches([batch for batch in map(self.read, product_codes) if batch is not None], schema=self.schema)
+
+    def close(self):
+        self.batches.clear()
+        self.source.close()
+
+
+if __name__ == '__main__':
+    # python reset_running_total/code/projection_reader.py stock_levels cupc01
+    result, product_code = sys.argv[1:3] if len(sys.argv) > 2 else ('stock_levels', 'cupc01')
+    reader = ProjectionReader(result)
+    start = time.perf_counter()
+    rows = reader.read(product_code)
+    print(f'{rows.num_rows} rows in {(time.perf_counter() - start) * 1e6:.0f} microseconds')
+    for row in rows.to_pylist():
+        print(row)
@@ -0,0 +1,88 @@
+import argparse
+import os
+
+import numpy as np
+import pyarrow as pa
+
+import export
+from ledger import open_ledger
+
+
+# Projection store for downstream readers: every result is written to an uncompressed arrow ipc file
+# (<store_dir>/<result>.arrow) with the rows of every product next to each other, in record batches that never split a
+# product. The schema metadata of the file holds the index: the batch, row offset and row count of every product.
+# projection_reader.py memory maps the file, so it reads a product without DuckDB and without copying.
+# Data and index are in one file that is replaced atomically: readers that still have the old file open keep reading
+# the old version, with its own index.
+
+BATCH_ROWS = 65_536
+
+INDEX_KEY = b'product_index'
+
+ORDER = "product_code, transaction_date nulls last, sort_order, reference_number"
+
+
+def index_batches(row_counts, batch_rows=BATCH_ROWS):
+    """Batch number and row offset within the batch of every product, for products with `row_counts` (in order).
+    A new batch starts when adding a product would make the batch larger than `batch_rows` rows."""
+    batches = np.zeros(len(row_counts), dtype=np.int32)
+    offsets = np.zeros(len(row_counts), dtype=np.int64)
+    batch, offset = 0, 0
+    for i, row_count in enumerate(row_counts):
+        if offset and offset + row_count > batch_rows:
+            batch, offset = batch + 1, 0
+        batches[i], offsets[i] = batch, offset
+        offset += row_count
+    return batches, offsets
+
+
+def serialize(table):
+    """`table` as arrow ipc stream bytes."""
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def write_ipc(path, table):
+    """Write the batches of `table` to an arrow ipc file at `path`, replacing it in one step."""
+    with pa.OSFile(f'{path}.tmp', 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+        for batch in table.to_batches():
+            writer.write_batch(batch)
+    os.replace(f'{path}.tmp', path)
+
+
+def write_store(con, result, store_dir='exports/projections', batch_rows=BATCH_ROWS):
+    """Write one of the export.RESULTS with its index to `store_dir`. Returns the path of the file."""
+    relation = export.RESULTS[result](con)
+    # sums are decimal(38, 0) in DuckDB, stored as bigint so readers can view them as NumPy int64 arrays
+    columns = ', '.join(f'{column}::bigint as {column}' if str(column_type) in ('DECIMAL(38,0)', 'HUGEINT') else column
+                        for column, column_type in zip(relation.columns, relation.types))
+    rows = con.sql(f"select {columns} from relation order by {ORDER}").to_arrow_table()
+    index = con.sql("select product_code, count(*) as row_count from rows group by product_code order by product_code").to_arrow_table()
+
+    row_counts = index['row_count'].to_numpy()
+    batches, offsets = index_batches(row_counts, batch_rows)
+    batch_starts = np.concatenate([[0], np.cumsum(row_counts)])[:-1][offsets == 0]
+    batch_ends = np.append(batch_starts[1:], rows.num_rows)
+    index = index.append_column('batch', pa.array(batches)).append_column('row_offset', pa.array(offsets))
+    schema = rows.schema.with_metadata({**(rows.schema.metadata or {}), INDEX_KEY: serialize(index)})
+    data = pa.Table.from_batches(
+        [rows.slice(start, end - start).combine_chunks().to_batches()[0] for start, end in zip(batch_starts, batch_ends)],
+        schema=schema,
+    )
+
+    os.makedirs(store_dir, exist_ok=True)
+    write_ipc(f'{store_dir}/{result}.arrow', data)
+    return f'{store_dir}/{result}.arrow'
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write the results to memory mappable arrow files, laid out by product.')
+    parser.add_argument('--results', nargs='+', default=list(export.RESULTS), choices=list(export.RESULTS))
+    parser.add_argument('--store-dir', default='exports/projections')
+    args = parser.parse_args()
+
+    con = open_ledger()
+    for result in args.results:
+        print(write_store(con, result, args.store_dir))
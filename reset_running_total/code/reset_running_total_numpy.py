@@ -0,0 +1,192 @@
+import numpy as np
+import pyarrow as pa
+
+from ledger import open_ledger
+
+
+# Same logic as reset_running_total.py, but instead of two window passes (and a sort for each of them)
+# the transactions (from the ledger) are sorted once and the running totals are calculated over flat NumPy arrays.
+
+QUESTION1_TRANSACTIONS = "select product_code, reference_number, qty, transaction_date, sort_order from fill_transactions"
+
+QUESTION2_TRANSACTIONS = "select product_code, reference_number, qty, transaction_date, sort_order from expiry_transactions"
+
+COLUMNS = ['product_code', 'reference_number', 'qty', 'transaction_date', 'sort_order']
+
+# Both questions from one sort of the ledger: its order (transaction_date, sort_order) is compatible with the order of
+# question 1 (transaction_date, sort_order >= 2) and of question 2 (transaction_date, sort_order >= 3).
+LEDGER_TRANSACTIONS = "select product_code, reference_number, produced_qty, ordered_qty, potential_waste_qty, transaction_date, sort_order from ledger"
+
+
+def run_starts(*keys):
+    """Boolean mask that is True on the first row of every run of equal (already sorted) keys."""
+    starts = np.zeros(len(keys[0]), dtype=bool)
+    if len(starts) > 0:
+        starts[0] = True
+        for key in keys:
+            starts[1:] |= key[1:] != key[:-1]
+    return starts
+
+
+def segmented_cumsum(values, segment_starts):
+    """Cumulative sum that restarts at every segment start."""
+    cumsum = np.cumsum(values)
+    offsets = (cumsum - values)[segment_starts]
+    return cumsum - np.repeat(offsets, np.diff(np.append(np.flatnonzero(segment_starts), len(values))))
+
+
+def segmented_cummin(values, segment_starts):
+    """Cumulative minimum that restarts at every segment start."""
+    if len(values) == 0:
+        return values.copy()
+    segment_id = np.cumsum(segment_starts) - 1
+    n_segments = segment_id[-1] + 1
+    span = int(values.max()) - int(values.min()) + 1
+    if span * n_segments < 2**62:
+        # lift every segment above all segments that follow it, so one global accumulate never leaks across segments
+        lift = (n_segments - 1 - segment_id) * span
+        return np.minimum.accumulate(values + lift) - lift
+    bounds = np.flatnonzero(segment_starts)[1:]
+    return np.concatenate([np.minimum.accumulate(part) for part in np.split(values, bounds)])
+
+
+def peer_values(values, peer_starts):
+    """Broadcast the value of the last row of every peer group to all rows of the group.
+    This mimics the default `range between unbounded preceding and current row` window frame."""
+    group_id = np.cumsum(peer_starts) - 1
+    group_ends = np.append(np.flatnonzero(peer_starts)[1:], len(values)) - 1
+    return values[group_ends[group_id]]
+
+
+def day_numbers(dates):
+    """Days since epoch of an arrow date column, with missing dates sorted last (like duckdb's default `nulls last`)."""
+    days = dates.cast(pa.int32()).to_numpy()
+    return np.nan_to_num(days, nan=np.iinfo(np.int32).max).astype(np.int32) if dates.null_count else days
+
+
+def calculate_running_totals(product_code, transaction_date, sort_order, qty, carry_running_total_v1=None, carry_min_running_total_v1=None):
+    """Returns (order, running_total_v1, min_running_total_v1, running_total_v2), with the totals in sorted order.
+
+    Equivalent to the window functions `partition by product_code order by transaction_date, sort_order`.
+    The optional carry arrays hold, per transaction, the running_total_v1 and min_running_total_v1 of the
+    earlier transactions of the same product that are not part of the input (used by the incremental mode)."""
+    product_ids = np.unique(product_code, return_inverse=True)[1]
+    order = np.lexsort((sort_order, transaction_date, product_ids))
+    product_ids = product_ids[order]
+    transaction_date = transaction_date[order]
+    sort_order = sort_order[order]
+
+    product_starts = run_starts(product_ids)
+    peer_starts = run_starts(product_ids, transaction_date, sort_order)
+
+    running_total_v1 = peer_values(segmented_cumsum(qty[order].astype(np.int64), product_starts), peer_starts)
+    if carry_running_total_v1 is not None:
+        running_total_v1 += carry_running_total_v1[order]
+    min_running_total_v1 = segmented_cummin(running_total_v1, product_starts)
+    if carry_min_running_total_v1 is not None:
+        min_running_total_v1 = np.minimum(min_running_total_v1, carry_min_running_total_v1[order])
+    running_total_v2 = np.where(min_running_total_v1 >= 0, running_total_v1, running_total_v1 - min_running_total_v1)
+    return order, running_total_v1, min_running_total_v1, running_total_v2
+
+
+def question_running_totals(qty, in_question, product_starts, peer_starts):
+    """running_total_v1, min_running_total_v1 and running_total_v2 of the rows where `in_question` is True, on arrays
+    that also hold the rows of the other question (which get the values of the last row of the question before them)."""
+    running_total_v1 = peer_values(segmented_cumsum(np.where(in_question, qty, 0), product_starts), peer_starts)
+    # the rows of the other question don't count in the minimum
+    ceiling = running_total_v1.max() if len(running_total_v1) > 0 else 0
+    min_running_total_v1 = segmented_cummin(np.where(in_question, running_total_v1, ceiling), product_starts)
+    running_total_v2 = np.where(min_running_total_v1 >= 0, running_total_v1, running_total_v1 - min_running_total_v1)
+    return running_total_v1, min_running_total_v1, running_total_v2
+
+
+def fill_and_expiry_table(transactions):
+    """Questions 1 and 2 side by side for an arrow table of ledger transactions (product_code, reference_number,
+    produced_qty, ordered_qty, potential_waste_qty, transaction_date, sort_order), sorted once.
+
+    Returns one row per transaction with the columns of result1 prefixed by fill_ and those of result2 prefixed by
+    expiry_ (qty, running_total_v1, min_running_total_v1, running_total_v2). They are null for transactions that are
+    not part of the question: question 1 has sort_order 0, 1 and 2, question 2 has 2, 3 and 4."""
+    product_ids = np.unique(transactions['product_code'].to_numpy(), return_inverse=True)[1]
+    transaction_date = day_numbers(transactions['transaction_date'])
+    sort_order = transactions['sort_order'].to_numpy()
+    order = np.lexsort((sort_order, transaction_date, product_ids))
+    transactions = transactions.take(order)
+    product_ids, transaction_date, sort_order = product_ids[order], transaction_date[order], sort_order[order]
+    product_starts = run_starts(product_ids)
+
+    produced_qty, ordered_qty, potential_waste_qty = (transactions[f'{name}_qty'].to_numpy().astype(np.int64) for name in ['produced', 'ordered', 'potential_waste'])
+    questions = {
+        'fill': (sort_order <= 2, produced_qty - ordered_qty, sort_order >= 2),
+        'expiry': (sort_order >= 2, ordered_qty - potential_waste_qty, sort_order >= 3),
+    }
+    result = transactions.select(['product_code', 'reference_number', 'transaction_date', 'sort_order'])
+    for question, (in_question, qty, question_sort_order) in questions.items():
+        peer_starts = run_starts(product_ids, transaction_date, question_sort_order)
+        not_in_question = ~in_question
+        result = result.append_column(f'{question}_qty', pa.array(qty, mask=not_in_question))
+        for name, values in zip(['running_total_v1', 'min_running_total_v1', 'running_total_v2'],
+                                question_running_totals(qty, in_question, product_starts, peer_starts)):
+            result = result.append_column(f'{question}_{name}', pa.array(values, mask=not_in_question))
+    return result
+
+
+def carry_column(transactions, column, missing):
+    """Optional carry column of the transactions as int64 array, with nulls (no earlier transactions) replaced by `missing`."""
+    if column not in transactions.column_names:
+        return None
+    return transactions[column].cast(pa.int64()).fill_null(missing).to_numpy()
+
+
+def reset_running_total_table(transactions):
+    """Calculate the reset running total for an arrow table of transactions (product_code, reference_number, qty,
+    transaction_date, sort_order). Returns an arrow table with the same columns as result1/result2 in reset_running_total.py.
+
+    If the transactions also have carry_running_total_v1 and carry_min_running_total_v1 columns, they continue
+    from those totals instead of starting from zero."""
+    order, running_total_v1, min_running_total_v1, running_total_v2 = calculate_running_totals(
+        transactions['product_code'].to_numpy(),
+        day_numbers(transactions['transaction_date']),
+        transactions['sort_order'].to_numpy(),
+        transactions['qty'].to_numpy(),
+        carry_column(transactions, 'carry_running_total_v1', 0),
+        carry_column(transactions, 'carry_min_running_total_v1', np.iinfo(np.int64).max),
+    )
+    result = transactions.select(COLUMNS).take(order)
+    result = result.append_column('running_total_v1', pa.array(running_total_v1))
+    result = result.append_column('min_running_total_v1', pa.array(min_running_total_v1))
+    result = result.append_column('running_total_v2', pa.array(running_total_v2))
+    return result
+
+
+def reset_running_total(con, transactions_sql):
+    """Calculate the reset running total for the transactions returned by `transactions_sql`, as a relation."""
+    return con.from_arrow(reset_running_total_table(con.sql(transactions_sql).to_arrow_table()))
+
+
+def result1(con):
+    """Question 1: can we fill the orders?"""
+    return reset_running_total(con, QUESTION1_TRANSACTIONS)
+
+
+def result2(con):
+    """Question 2: will it expire?"""
+    return reset_running_total(con, QUESTION2_TRANSACTIONS)
+
+
+def fill_and_expiry(con):
+    """Questions 1 and 2 side by side (see fill_and_expiry_table), as a relation."""
+    return con.from_arrow(fill_and_expiry_table(con.sql(LEDGER_TRANSACTIONS).to_arrow_table()))
+
+
+if __name__ == '__main__':
+    con = open_ledger()
+
+    result1_numpy = result1(con)
+    con.sql("select * from result1_numpy where product_code = 'cupc01'").show()
+
+    result2_numpy = result2(con)
+    con.sql("select * from result2_numpy where product_code = 'cupc01'").show()
+
+    fill_and_expiry_numpy = fill_and_expiry(con)
+    con.sql("select * from fill_and_expiry_numpy where product_code = 'cupc01'").show()
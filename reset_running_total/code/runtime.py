@@ -0,0 +1,106 @@
+import argparse
+import tomllib
+
+import profiling
+from ledger import LEDGER_DATABASE, open_ledger
+from sharded import shard_connection
+from tables import DATA_DIR
+
+
+# Runtime configuration for large runs: the pipelines get a dedicated DuckDB connection with explicit threads, memory
+# limit and spill (temp) directory, read from a toml file and/or command line options, e.g.
+#
+#   [duckdb]
+#   threads = 16
+#   memory_limit = "32GB"
+#   temp_directory = "/scratch/duckdb_spill"
+#   max_temp_directory_size = "500GB"
+#   preserve_insertion_order = false
+#
+# All command line scripts that run the analyses (scheduler.py, export.py, pipeline.py, analyses.py, profiling.py)
+# take these options (add_arguments) and connect through connect_from_args.
+# With a memory limit, operators that do not fit (sorts, windows, the recursive CTE) spill to the temp directory
+# instead of running out of memory. The run reports per stage how much was spilled.
+
+SETTINGS = ['threads', 'memory_limit', 'temp_directory', 'max_temp_directory_size', 'preserve_insertion_order']
+
+
+def load_config(path):
+    """DuckDB settings from the [duckdb] table of a toml file."""
+    with open(path, 'rb') as f:
+        config = tomllib.load(f).get('duckdb', {})
+    unknown = set(config) - set(SETTINGS)
+    if unknown:
+        raise ValueError(f"unknown settings in {path}: {', '.join(sorted(unknown))}")
+    return config
+
+
+def parse_bool(value):
+    """true or false (any case), for boolean command line options."""
+    if value.lower() not in ('true', 'false'):
+        raise argparse.ArgumentTypeError(f"expected true or false, got '{value}'")
+    return value.lower() == 'true'
+
+
+def connect(config, data_dir=DATA_DIR, database=LEDGER_DATABASE):
+    """Build (or check) the ledger with `config`, and return an in-memory connection with the same settings on top
+    of the (read only) ledger, for the stage tables."""
+    config = {setting: value for setting, value in config.items() if value is not None}
+    open_ledger(data_dir, database, config).close()
+    return shard_connection(database, 0, 1, config=config)
+
+
+def add_arguments(parser):
+    """Add the options of connect to the command line `parser`: --config, the settings, --data-dir and --database."""
+    parser.add_argument('--config', help='toml file with a [duckdb] table, overridden by the options below')
+    parser.add_argument('--threads', type=int)
+    parser.add_argument('--memory-limit', help='e.g. 32GB')
+    parser.add_argument('--temp-directory', help='directory for data that is spilled to disk')
+    parser.add_argument('--max-temp-directory-size', help='e.g. 500GB')
+    parser.add_argument('--preserve-insertion-order', type=parse_bool, help='true or false')
+    parser.add_argument('--data-dir', default=DATA_DIR)
+    parser.add_argument('--database', default=LEDGER_DATABASE)
+
+
+def connect_from_args(args):
+    """connect() with the config file and settings of command line options added by add_arguments."""
+    config = load_config(args.config) if args.config else {}
+    config.update({setting: getattr(args, setting) for setting in SETTINGS if getattr(args, setting) is not None})
+    return connect(config, args.data_dir, args.database)
+
+
+def settings(con):
+    """The settings in effect on `con`."""
+    return {setting: con.sql(f"select current_setting('{setting}')").fetchone()[0] for setting in SETTINGS}
+
+
+def spill_report(con, latest_only=True):
+    """Run part 1, the recursive lower bounds and the stock levels (see profiling.profile), and report per stage
+    the peak memory of the buffer manager and the peak temp storage, both sampled while the stage ran. A stage spilled
+    if the temp storage went up during the stage (earlier stage tables can stay spilled in the temp storage)."""
+    report = profiling.profile(con, latest_only)
+    stages = []
+    for stage in report['stages']:
+        stages.append({
+            'stage': stage['stage'],
+            'seconds': stage['seconds'],
+            'rows': stage['rows'],
+            'peak_buffer_memory': stage['peak_buffer_memory'],
+            'peak_temp_storage': stage['peak_temp_storage'],
+            'spilled': stage['peak_temp_storage'] > stage['temp_storage_before'],
+        })
+    return {'settings': settings(con), 'stages': stages}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the FIFO stock level projections with explicit DuckDB resources and report spilling.')
+    add_arguments(parser)
+    parser.add_argument('--full-history', action='store_true', help='keep all iterations of the recursive CTE')
+    args = parser.parse_args()
+
+    con = connect_from_args(args)
+    report = spill_report(con, latest_only=not args.full_history)
+    print('settings:', report['settings'])
+    for stage in report['stages']:
+        print(f"{stage['stage']}: {stage['seconds']:.3f}s, {stage['rows']} rows, peak memory {stage['peak_buffer_memory']} bytes, "
+              f"{'spilled, ' if stage['spilled'] else ''}peak temp storage {stage['peak_temp_storage']} bytes")
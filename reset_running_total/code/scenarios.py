@@ -0,0 +1,137 @@
+import FIFO_stock_level_projections_numpy
+from ledger import SOURCE_TRANSACTIONS, open_ledger
+from tables import KEYS, SCHEMAS, TABLES
+
+
+# What-if scenarios: every scenario is a set of deltas against the input tables (changed, added or cancelled rows).
+# All scenarios are evaluated in one run, with scenario_id added to the partition key of the ledger windows and of the
+# lower bound calculations. Only the products a scenario touches are recalculated, all other products keep the results
+# of the base ledger.
+
+# Rows of a delta table replace the row of the input table with the same product_code and key (see tables.KEYS), or
+# are added if there is none.
+
+TOUCHED_PRODUCTS = """
+create or replace temp table touched_products as
+""" + "\nunion\n".join(f"select scenario_id, product_code from {table}_deltas" for table in TABLES) + "\n"
+
+# The input table as seen by every scenario, for the products it touches.
+SCENARIO_TABLE = """
+create or replace temp view scenario_{table} as
+select
+    touched_products.scenario_id,
+    t.*
+from
+    touched_products
+    inner join {table} as t
+        on t.product_code = touched_products.product_code
+where
+    not exists (select 1 from {table}_deltas as d where d.scenario_id = touched_products.scenario_id and d.product_code = t.product_code and d.{key} = t.{key})
+union all
+select scenario_id, {columns} from {table}_deltas where not cancelled
+"""
+
+SCENARIO_TRANSACTIONS = SOURCE_TRANSACTIONS.format(
+    view='scenario_source_transactions', key='scenario_id, ', stock='scenario_stock', production_orders='scenario_production_orders',
+    customer_orders='scenario_customer_orders', products='scenario_products',
+).replace('create or replace view', 'create or replace temp view')
+
+# the running totals of the ledger and the reference numbers of fifo_transactions, per scenario
+SCENARIO_FIFO_TRANSACTIONS = """
+select
+    scenario_id,
+    product_code,
+    case when sort_order >= 3 then concat('WASTE ', reference_number) else reference_number end as reference_number,
+    produced_qty,
+    ordered_qty,
+    potential_waste_qty,
+    transaction_date,
+    sort_order,
+    sum(produced_qty) over (partition by scenario_id, product_code order by transaction_date, sort_order, reference_number) as RT_produced,
+    sum(ordered_qty) over (partition by scenario_id, product_code order by transaction_date, sort_order, reference_number) as RT_ordered,
+    sum(potential_waste_qty) over (partition by scenario_id, product_code order by transaction_date, sort_order, reference_number) as RT_potential_waste
+from
+    scenario_source_transactions
+order by
+    scenario_id, product_code, transaction_date, sort_order, reference_number
+"""
+
+# missed sales and waste of every touched product, in the scenario and in the base ledger. The totals are the last
+# running totals (lower bounds never go down, so the max): missed_sales_qty and waste_qty are null on the first row.
+SCENARIO_SUMMARY = """
+with scenario as (
+    select
+        scenario_id,
+        product_code,
+        max(RT_missed_sales) as missed_sales_qty,
+        max(RT_waste) as waste_qty
+    from
+        scenario_stock_levels
+    group by
+        scenario_id, product_code
+),
+base as (
+    select
+        product_code,
+        max(RT_missed_sales) as base_missed_sales_qty,
+        max(RT_waste) as base_waste_qty
+    from
+        base_stock_levels
+    group by
+        product_code
+)
+
+select
+    touched_products.scenario_id,
+    touched_products.product_code,
+    coalesce(scenario.missed_sales_qty, 0) as missed_sales_qty,
+    coalesce(scenario.waste_qty, 0) as waste_qty,
+    coalesce(base.base_missed_sales_qty, 0) as base_missed_sales_qty,
+    coalesce(base.base_waste_qty, 0) as base_waste_qty
+from
+    touched_products
+    left join scenario
+        on scenario.scenario_id = touched_products.scenario_id and scenario.product_code = touched_products.product_code
+    left join base
+        on base.product_code = touched_products.product_code
+order by
+    touched_products.scenario_id, touched_products.product_code
+"""
+
+
+def create_delta_tables(con):
+    """Create an empty `<table>_deltas` table for every input table: scenario_id, the columns of the input table and `cancelled`.
+    A delta row replaces the row with the same key (see KEYS) in its scenario, or removes it if `cancelled`."""
+    for table, schema in SCHEMAS.items():
+        columns = ', '.join(f'{column} {column_type}' for column, column_type in schema.items())
+        con.execute(f"create or replace table {table}_deltas (scenario_id varchar, {columns}, cancelled boolean default false)")
+
+
+def evaluate_scenarios(con):
+    """Stock levels of the products touched by every scenario in the delta tables, in one run.
+    Returns (scenario_stock_levels, summary): the stock_levels columns with a leading scenario_id, and per scenario
+    and product the total missed sales and waste next to those of the base ledger."""
+    con.execute(TOUCHED_PRODUCTS)
+    for table, schema in SCHEMAS.items():
+        con.execute(SCENARIO_TABLE.format(table=table, key=KEYS[table], columns=', '.join(schema)))
+    con.execute(SCENARIO_TRANSACTIONS)
+
+    scenario_stock_levels = con.from_arrow(FIFO_stock_level_projections_numpy.stock_levels_table(
+        con.sql(SCENARIO_FIFO_TRANSACTIONS).to_arrow_table()))
+    base_stock_levels = FIFO_stock_level_projections_numpy.stock_levels(
+        con, "select * from fifo_transactions where product_code in (select product_code from touched_products)")
+    return scenario_stock_levels, con.sql(SCENARIO_SUMMARY)
+
+
+if __name__ == '__main__':
+    con = open_ledger()
+    create_delta_tables(con)
+    # production orders of cupc01 two days late, a shorter shelf life, and a cancelled customer order
+    con.execute("insert into production_orders_deltas select 'late production', *, false from production_orders where product_code = 'cupc01'")
+    con.execute("update production_orders_deltas set production_date = production_date + 2")
+    con.execute("insert into products_deltas select 'short shelf life', product_code, description, shelf_life_days - 2, false from products where product_code = 'cupc01'")
+    con.execute("insert into customer_orders_deltas select 'cancelled order', *, true from customer_orders where customer_order_number = 'c#126'")
+
+    scenario_stock_levels, summary = evaluate_scenarios(con)
+    summary.show()
+    con.sql("select * from scenario_stock_levels where scenario_id = 'late production' order by product_code, transaction_date, sort_order, reference_number").show()
@@ -0,0 +1,97 @@
+import argparse
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import export
+import runtime
+from pipeline import fifo_stages
+
+
+# Concurrent stage scheduler: all analyses in one process, on one loaded ledger. The stages (see pipeline.fifo_stages)
+# form a dependency graph, of which only the outputs and the stages they read are run. Every stage whose dependencies
+# are done is started right away in a thread pool, on its own cursor of the connection. The result of a stage is kept
+# as an arrow table and registered (under the stage name) on the cursors of the stages that read it. Intermediate
+# stages are freed as soon as all stages that read them are done.
+# The total run time is close to the longest chain of dependent stages, instead of the sum of all stages.
+
+
+def run_stage(con, stage, function, dependencies, results):
+    cursor = con.cursor()
+    try:
+        for dependency in dependencies:
+            cursor.register(dependency, results[dependency])
+        start = time.perf_counter()
+        result = function(cursor).to_arrow_table()
+        return result, start, time.perf_counter()
+    finally:
+        cursor.close()
+
+
+def needed_stages(stages, outputs):
+    """The `outputs` and every stage they depend on, directly or indirectly."""
+    needed = set()
+    to_visit = list(outputs)
+    while to_visit:
+        stage = to_visit.pop()
+        if stage not in needed:
+            needed.add(stage)
+            to_visit.extend(stages[stage][1])
+    return needed
+
+
+def run(con, stages, outputs=None, max_workers=None):
+    """Run the `outputs` (default: all stages) and the stages they depend on, independent stages concurrently.
+    Returns the arrow tables of the `outputs` by stage name, and a log with the start and end time of every stage
+    (in seconds since the start of the run)."""
+    outputs = set(stages if outputs is None else outputs)
+    stages = {stage: stages[stage] for stage in stages if stage in needed_stages(stages, outputs)}
+    results = {}
+    finished = set()
+    log = []
+    pending = dict(stages)
+    running = {}
+    run_start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers) as pool:
+        while pending or running:
+            for stage, (function, dependencies) in list(pending.items()):
+                if all(dependency in finished for dependency in dependencies):
+                    running[pool.submit(run_stage, con, stage, function, dependencies, results)] = stage
+                    del pending[stage]
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage = running.pop(future)
+                results[stage], start, end = future.result()
+                finished.add(stage)
+                log.append({'stage': stage, 'start': start - run_start, 'end': end - run_start, 'rows': results[stage].num_rows})
+
+            # free the dependencies that are no longer needed
+            for stage in list(results):
+                consumers = [name for name, (_, dependencies) in stages.items() if stage in dependencies]
+                if stage not in outputs and all(consumer in finished for consumer in consumers):
+                    del results[stage]
+    return results, log
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run all analyses in one process, independent stages concurrently.')
+    runtime.add_arguments(parser)
+    parser.add_argument('--outputs', nargs='+', default=['result1', 'result2', 'part1', 'stock_levels'], choices=list(fifo_stages()))
+    parser.add_argument('--output-dir', help='write the outputs to <output-dir>/<stage>, partitioned by product_code')
+    parser.add_argument('--format', default='parquet', choices=export.FORMATS)
+    parser.add_argument('--workers', type=int, help='number of stages that run at the same time (default: all that can)')
+    parser.add_argument('--full-history', action='store_true', help='keep all iterations of the recursive CTE')
+    args = parser.parse_args()
+
+    con = runtime.connect_from_args(args)
+    results, log = run(con, fifo_stages(latest_only=not args.full_history), args.outputs, args.workers)
+    for entry in sorted(log, key=lambda entry: entry['start']):
+        print(f"{entry['stage']}: {entry['start']:.3f}s - {entry['end']:.3f}s, {entry['rows']} rows")
+    print(f"total: {max(entry['end'] for entry in log):.3f}s, sum of stages: {sum(entry['end'] - entry['start'] for entry in log):.3f}s")
+
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+        for stage, result in results.items():
+            export.write(con, con.from_arrow(result), f'{args.output_dir}/{stage}', args.format)
+            print(f'{args.output_dir}/{stage}')
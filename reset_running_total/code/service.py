@@ -0,0 +1,149 @@
+import argparse
+import json
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import duckdb # documentation available on https://duckdb.org/docs/api/python/overview
+import pyarrow.compute as pc
+
+from FIFO_stock_level_projections_numpy import stock_levels_table
+from incremental import CHANGED_PRODUCTS
+from ledger import TRANSACTIONS, build_ledger, ledger_is_current
+from reset_running_total_numpy import QUESTION1_TRANSACTIONS, QUESTION2_TRANSACTIONS, reset_running_total_table
+from tables import DATA_DIR, load_tables
+
+
+# Projection service: keeps the input tables and the ledger in memory and answers lookups for one product at a time.
+# Results are calculated per product on first use and kept in an LRU cache. When the csv files change, the ledger is
+# rebuilt and only the products with new, changed or removed transactions are dropped from the cache.
+#
+#   python reset_running_total/code/service.py --port 8000
+#   curl 'localhost:8000/stock_levels?product_code=cupc01'
+#   curl 'localhost:8000/can_fill?customer_order_number=c%23125&product_code=cupc01'
+#   curl -X POST localhost:8000/refresh
+
+CACHE_SIZE = 1024 # number of (analysis, product) results
+
+ANALYSES = {
+    'result1': (f"select * from ({QUESTION1_TRANSACTIONS}) where product_code = $product_code", reset_running_total_table),
+    'result2': (f"select * from ({QUESTION2_TRANSACTIONS}) where product_code = $product_code", reset_running_total_table),
+    'stock_levels': ("""
+        select * from fifo_transactions where product_code = $product_code
+        order by transaction_date, sort_order, reference_number
+    """, stock_levels_table),
+}
+
+
+class ProjectionService:
+    def __init__(self, data_dir=DATA_DIR, database=':memory:', cache_size=CACHE_SIZE):
+        self.data_dir = data_dir
+        self.cache_size = cache_size
+        self.cache = OrderedDict() # (analysis, product_code): arrow table, least recently used first
+        self.con = duckdb.connect(database)
+        hashes = load_tables(self.con, data_dir)
+        if not ledger_is_current(self.con, hashes):
+            build_ledger(self.con, data_dir, hashes)
+
+    def lookup(self, analysis, product_code):
+        """Result of one analysis (see ANALYSES) for one product, as an arrow table."""
+        key = (analysis, product_code)
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+        transactions_sql, calculate = ANALYSES[analysis]
+        result = calculate(self.con.sql(transactions_sql, params={'product_code': product_code}).to_arrow_table())
+        self.cache[key] = result
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return result
+
+    def can_fill(self, customer_order_number, product_code=None):
+        """FIFO projection of a customer order: sold and missed quantity. Order numbers are only unique within a
+        product, so this returns a list with the order of every product (only `product_code`, if given)."""
+        orders = self.con.sql(
+            "select product_code from customer_orders where customer_order_number = $customer_order_number"
+            " and product_code = coalesce($product_code, product_code) order by product_code",
+            params={'customer_order_number': customer_order_number, 'product_code': product_code},
+        ).fetchall()
+        answers = []
+        for order_product_code, in orders:
+            stock_levels = self.lookup('stock_levels', order_product_code)
+            # batches, production orders and customer orders share reference_number: only customer orders (sort_order 2)
+            rows = stock_levels.filter(pc.and_(
+                pc.equal(stock_levels['reference_number'], customer_order_number), pc.equal(stock_levels['sort_order'], 2),
+            )).to_pylist()
+            if not rows:
+                raise LookupError(f"no stock level of customer order {customer_order_number} of product {order_product_code}")
+            row = rows[0]
+            # the first transaction of a product has no lag, so no sold_qty: there is nothing to sell from yet
+            sold_qty = row['sold_qty'] if row['sold_qty'] is not None else 0
+            answers.append({
+                'product_code': row['product_code'],
+                'customer_order_number': customer_order_number,
+                'delivery_date': row['transaction_date'],
+                'ordered_qty': row['ordered_qty'],
+                'sold_qty': sold_qty,
+                'missed_sales_qty': row['ordered_qty'] - sold_qty,
+                'can_fill': sold_qty == row['ordered_qty'],
+            })
+        return answers
+
+    def refresh(self):
+        """Reload changed csv files and rebuild the ledger. Returns the product codes dropped from the cache."""
+        hashes = load_tables(self.con, self.data_dir)
+        if ledger_is_current(self.con, hashes):
+            return []
+        self.con.execute(TRANSACTIONS)
+        self.con.execute(CHANGED_PRODUCTS)
+        changed_products = [product_code for product_code, in self.con.sql("select product_code from changed_products order by product_code").fetchall()]
+        build_ledger(self.con, self.data_dir, hashes)
+        for key in [key for key in self.cache if key[1] in changed_products]:
+            del self.cache[key]
+        return changed_products
+
+
+def handler(service):
+    class ProjectionRequestHandler(BaseHTTPRequestHandler):
+        def send_json(self, status, body):
+            content = json.dumps(body, default=str).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            parameters = {name: values[0] for name, values in parse_qs(url.query).items()}
+            analysis = url.path.strip('/')
+            if analysis in ANALYSES and 'product_code' in parameters:
+                self.send_json(200, service.lookup(analysis, parameters['product_code']).to_pylist())
+            elif analysis == 'can_fill' and 'customer_order_number' in parameters:
+                answers = service.can_fill(parameters['customer_order_number'], parameters.get('product_code'))
+                self.send_json(200 if answers else 404, answers or {'error': 'unknown customer order'})
+            else:
+                self.send_json(404, {'error': f'use /<{"|".join(ANALYSES)}>?product_code=... or /can_fill?customer_order_number=...[&product_code=...]'})
+
+        def do_POST(self):
+            if urlparse(self.path).path.strip('/') == 'refresh':
+                self.send_json(200, {'invalidated_products': service.refresh()})
+            else:
+                self.send_json(404, {'error': 'use /refresh'})
+
+    return ProjectionRequestHandler
+
+
+def serve(service, host='localhost', port=8000):
+    # requests are handled one at a time: they share the connection and the cache of the service
+    HTTPServer((host, port), handler(service)).serve_forever()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve stock level projections and reset running totals per product over http.')
+    parser.add_argument('--data-dir', default=DATA_DIR)
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--cache-size', type=int, default=CACHE_SIZE)
+    args = parser.parse_args()
+    serve(ProjectionService(args.data_dir, cache_size=args.cache_size), args.host, args.port)
@@ -0,0 +1,58 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import duckdb # documentation available on https://duckdb.org/docs/api/python/overview
+import pyarrow as pa
+
+import analyses
+from ledger import EXPIRY_TRANSACTIONS, FIFO_TRANSACTIONS, FILL_TRANSACTIONS, LEDGER_DATABASE, open_ledger
+from tables import DATA_DIR
+
+
+# All windows are partitioned by product_code and the recursion never crosses products, so the ledger can be split
+# into shards of products that are processed independently. Every worker process opens its own connection on the
+# (read only) ledger database and only sees the products of its shard. The shard results are concatenated at the end.
+
+
+def shard_connection(database, shard, n_shards, threads=None, config=None):
+    """In-memory connection where `ledger` (and the views on top of it) only holds the products of one shard.
+    `config` holds DuckDB settings for the connection (see runtime.py)."""
+    con = duckdb.connect(config=config or {})
+    if threads:
+        con.execute(f"set threads = {threads}")
+    con.execute(f"attach '{database}' as ledger_database (read_only)")
+    con.execute(f"create view ledger as select * from ledger_database.ledger where hash(product_code) % {n_shards} = {shard}")
+    con.execute(FILL_TRANSACTIONS)
+    con.execute(EXPIRY_TRANSACTIONS)
+    con.execute(FIFO_TRANSACTIONS)
+    return con
+
+
+def run_shard(database, shard, n_shards, threads=None, latest_only=True):
+    """Part 1 and the stock levels of one shard, as arrow tables (so they can be sent back to the parent process)."""
+    con = shard_connection(database, shard, n_shards, threads)
+    return {
+        'part1': analyses.part1(con).to_arrow_table(),
+        'stock_levels': analyses.stock_levels(con, latest_only).to_arrow_table(),
+    }
+
+
+def run_sharded(n_shards=None, data_dir=DATA_DIR, database=LEDGER_DATABASE, latest_only=True):
+    """Run part 1 and the stock levels in `n_shards` worker processes (default: one per cpu).
+    Returns a dict of arrow tables with the results of all shards."""
+    n_shards = n_shards or os.cpu_count()
+    # build (or check) the ledger first, and release the database so the workers can open it
+    open_ledger(data_dir, database).close()
+
+    threads = max(1, os.cpu_count() // n_shards)
+    with ProcessPoolExecutor(max_workers=n_shards) as pool:
+        shard_results = list(pool.map(run_shard, [database] * n_shards, range(n_shards), [n_shards] * n_shards,
+                                      [threads] * n_shards, [latest_only] * n_shards))
+
+    return {name: pa.concat_tables([result[name] for result in shard_results]) for name in shard_results[0]}
+
+
+if __name__ == '__main__':
+    results = run_sharded()
+    stock_levels = results['stock_levels']
+    duckdb.sql("select * from stock_levels where product_code = 'cupc01' order by transaction_date, sort_order, reference_number").show()
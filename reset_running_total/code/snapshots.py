@@ -0,0 +1,250 @@
+import datetime
+
+import pyarrow as pa
+
+import FIFO_stock_level_projections_numpy
+import reset_running_total_numpy
+from fifo_allocation import LEDGER_TRANSACTIONS, allocate
+from ledger import open_ledger
+
+
+# Horizon cutoff and state snapshots. A snapshot at a cutoff date holds, per product, the state after all transactions
+# before that date: the running totals, the minima that the reset running totals and the lower bounds continue from,
+# and the FIFO batches that still have stock (with their expiration dates). Projections start from the latest snapshot
+# and only calculate the transactions from its cutoff date up to the horizon date.
+# Transactions before the cutoff date are assumed to never change: take a new snapshot (from an earlier one, or from
+# scratch after dropping the snapshot tables) if they do.
+# As in incremental.py, products that hit the recursion safeguard can get other lower bounds than in a full run.
+
+SNAPSHOT_TABLES = ['snapshots', 'snapshot_batches']
+
+CREATE_SNAPSHOT_TABLES = """
+create table if not exists snapshots (
+    cutoff_date date,
+    product_code varchar,
+    RT_produced bigint,
+    RT_ordered bigint,
+    RT_potential_waste bigint,
+    fill_running_total_v1 bigint,
+    fill_min_running_total_v1 bigint,
+    expiry_running_total_v1 bigint,
+    expiry_min_running_total_v1 bigint,
+    min_missed_sales bigint,
+    min_waste bigint,
+    RT_missed_sales bigint,
+    RT_waste bigint,
+    primary key (cutoff_date, product_code)
+);
+create table if not exists snapshot_batches (
+    cutoff_date date,
+    product_code varchar,
+    queue_position integer,
+    batch_number varchar,
+    remaining_qty bigint,
+    expiration_date date,
+    primary key (cutoff_date, product_code, batch_number)
+);
+"""
+
+RESET_RUNNING_TOTAL_FROM_SNAPSHOT = """
+select
+    t.product_code,
+    t.reference_number,
+    t.qty,
+    t.transaction_date,
+    t.sort_order,
+    s.{question}_running_total_v1 as carry_running_total_v1,
+    s.{question}_min_running_total_v1 as carry_min_running_total_v1
+from
+    {transactions} as t
+    left join snapshots as s
+        on s.product_code = t.product_code and s.cutoff_date = {cutoff_date}
+where
+    {period}
+"""
+
+STOCK_LEVELS_FROM_SNAPSHOT = """
+select
+    t.*,
+    s.min_missed_sales as carry_min_missed_sales,
+    s.min_waste as carry_min_waste,
+    s.RT_missed_sales as carry_RT_missed_sales,
+    s.RT_waste as carry_RT_waste
+from
+    fifo_transactions as t
+    left join snapshots as s
+        on s.product_code = t.product_code and s.cutoff_date = {cutoff_date}
+where
+    {period}
+"""
+
+# Products without transactions in the period keep the state of the previous snapshot.
+SAVE_SNAPSHOT = """
+insert into snapshots
+with previous as (
+    select * from snapshots where cutoff_date = {previous_cutoff_date}
+),
+period_totals as (
+    select
+        product_code,
+        sum(produced_qty) as produced_qty,
+        sum(ordered_qty) as ordered_qty,
+        sum(potential_waste_qty) as potential_waste_qty
+    from
+        ledger
+    where
+        {period}
+    group by
+        product_code
+),
+running_totals as (
+    -- the running totals of the previous snapshot plus the transactions of the period
+    select
+        coalesce(period_totals.product_code, previous.product_code) as product_code,
+        coalesce(previous.RT_produced, 0) + coalesce(period_totals.produced_qty, 0) as RT_produced,
+        coalesce(previous.RT_ordered, 0) + coalesce(period_totals.ordered_qty, 0) as RT_ordered,
+        coalesce(previous.RT_potential_waste, 0) + coalesce(period_totals.potential_waste_qty, 0) as RT_potential_waste
+    from
+        period_totals
+        full join previous
+            on previous.product_code = period_totals.product_code
+),
+result1_state as (
+    select product_code, min(min_running_total_v1) as min_running_total_v1 from period_result1 group by product_code
+),
+result2_state as (
+    select product_code, min(min_running_total_v1) as min_running_total_v1 from period_result2 group by product_code
+),
+stock_levels_state as (
+    select
+        product_code,
+        min(RT_produced - RT_waste - RT_ordered) as min_missed_sales,
+        min(RT_ordered - RT_missed_sales - RT_potential_waste) as min_waste,
+        max(RT_missed_sales) as RT_missed_sales, -- lower bounds never go down, so this is the last one
+        max(RT_waste) as RT_waste
+    from
+        period_stock_levels
+    group by
+        product_code
+)
+
+select
+    {cutoff_date} as cutoff_date,
+    running_totals.product_code,
+    running_totals.RT_produced,
+    running_totals.RT_ordered,
+    running_totals.RT_potential_waste,
+    running_totals.RT_produced - running_totals.RT_ordered as fill_running_total_v1,
+    least(previous.fill_min_running_total_v1, result1_state.min_running_total_v1) as fill_min_running_total_v1,
+    running_totals.RT_ordered - running_totals.RT_potential_waste as expiry_running_total_v1,
+    least(previous.expiry_min_running_total_v1, result2_state.min_running_total_v1) as expiry_min_running_total_v1,
+    least(previous.min_missed_sales, stock_levels_state.min_missed_sales) as min_missed_sales,
+    least(previous.min_waste, stock_levels_state.min_waste) as min_waste,
+    greatest(previous.RT_missed_sales, stock_levels_state.RT_missed_sales) as RT_missed_sales,
+    greatest(previous.RT_waste, stock_levels_state.RT_waste) as RT_waste
+from
+    running_totals
+    left join previous using (product_code)
+    left join result1_state using (product_code)
+    left join result2_state using (product_code)
+    left join stock_levels_state using (product_code)
+"""
+
+SAVE_SNAPSHOT_BATCHES = """
+insert into snapshot_batches
+select
+    {cutoff_date} as cutoff_date,
+    b.product_code,
+    row_number() over (partition by b.product_code order by b.position) as queue_position,
+    b.batch_number,
+    b.remaining_qty,
+    expirations.transaction_date as expiration_date
+from
+    period_open_batches as b
+    left join ledger as expirations
+        on expirations.product_code = b.product_code
+        and expirations.reference_number = b.batch_number
+        and expirations.sort_order in (3, 4)
+"""
+
+OPEN_BATCHES = """
+select product_code, batch_number, remaining_qty
+from snapshot_batches
+where cutoff_date = {cutoff_date}
+order by product_code, queue_position
+"""
+
+
+def date_literal(date):
+    return f"date '{date}'" if date else 'null'
+
+
+def period(table, start_date=None, end_date=None):
+    """Transactions from `start_date` up to (not including) `end_date`. Transactions without a date sort last."""
+    conditions = []
+    if start_date:
+        conditions.append(f"({table}.transaction_date >= {date_literal(start_date)} or {table}.transaction_date is null)")
+    if end_date:
+        conditions.append(f"{table}.transaction_date < {date_literal(end_date)}")
+    return ' and '.join(conditions) or 'true'
+
+
+def latest_snapshot(con, before=None):
+    """Cutoff date of the latest snapshot (on or before `before`), None if there is none."""
+    con.execute(CREATE_SNAPSHOT_TABLES)
+    condition = f"where cutoff_date <= {date_literal(before)}" if before else ''
+    return con.sql(f"select max(cutoff_date) from snapshots {condition}").fetchone()[0]
+
+
+def calculate(con, start_date, end_date):
+    """result1, result2, stock_levels (as relations) and the FIFO allocation (as arrow tables) of the transactions from
+    the snapshot at `start_date` (None: the first transaction) up to `end_date` (None: the last transaction)."""
+    cutoff_date = date_literal(start_date)
+    result1 = reset_running_total_numpy.reset_running_total(con, RESET_RUNNING_TOTAL_FROM_SNAPSHOT.format(
+        question='fill', transactions='fill_transactions', cutoff_date=cutoff_date, period=period('t', start_date, end_date)))
+    result2 = reset_running_total_numpy.reset_running_total(con, RESET_RUNNING_TOTAL_FROM_SNAPSHOT.format(
+        question='expiry', transactions='expiry_transactions', cutoff_date=cutoff_date, period=period('t', start_date, end_date)))
+    stock_levels = FIFO_stock_level_projections_numpy.stock_levels(con, STOCK_LEVELS_FROM_SNAPSHOT.format(
+        cutoff_date=cutoff_date, period=period('t', start_date, end_date)))
+    allocation = allocate(
+        con.sql(f"select * from ({LEDGER_TRANSACTIONS}) as t where {period('t', start_date, end_date)}").to_arrow_table(),
+        con.sql(OPEN_BATCHES.format(cutoff_date=cutoff_date)).to_arrow_table() if start_date else None,
+    )
+    return result1, result2, stock_levels, allocation
+
+
+def project(con, horizon_date=None):
+    """result1, result2, stock_levels, allocations and waste (as relations) up to and including `horizon_date`,
+    starting from the latest snapshot on or before it."""
+    end_date = horizon_date + datetime.timedelta(days=1) if horizon_date else None
+    result1, result2, stock_levels, (allocations, waste, _) = calculate(con, latest_snapshot(con, horizon_date), end_date)
+    return {
+        'result1': result1,
+        'result2': result2,
+        'stock_levels': stock_levels,
+        'allocations': con.from_arrow(allocations),
+        'waste': con.from_arrow(waste),
+    }
+
+
+def take_snapshot(con, cutoff_date):
+    """Save the state of every product before `cutoff_date`, calculated from the latest earlier snapshot."""
+    previous_cutoff_date = latest_snapshot(con, cutoff_date - datetime.timedelta(days=1))
+    period_result1, period_result2, period_stock_levels, (_, _, period_open_batches) = calculate(con, previous_cutoff_date, cutoff_date)
+    period_open_batches = period_open_batches.append_column('position', pa.array(range(period_open_batches.num_rows)))
+    con.execute(f"delete from snapshots where cutoff_date = {date_literal(cutoff_date)}")
+    con.execute(f"delete from snapshot_batches where cutoff_date = {date_literal(cutoff_date)}")
+    con.execute(SAVE_SNAPSHOT.format(cutoff_date=date_literal(cutoff_date), previous_cutoff_date=date_literal(previous_cutoff_date),
+                                     period=period('ledger', previous_cutoff_date, cutoff_date)))
+    con.execute(SAVE_SNAPSHOT_BATCHES.format(cutoff_date=date_literal(cutoff_date)))
+
+
+if __name__ == '__main__':
+    con = open_ledger()
+    take_snapshot(con, datetime.date(2024, 8, 1))
+    con.sql("select * from snapshots where product_code = 'cupc01'").show()
+    con.sql("select * from snapshot_batches where product_code = 'cupc01'").show()
+
+    projections = project(con, horizon_date=datetime.date(2024, 8, 31))
+    projections['stock_levels'].filter("product_code = 'cupc01'").show()
+    projections['allocations'].filter("product_code = 'cupc01'").show()
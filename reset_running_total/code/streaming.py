@@ -0,0 +1,59 @@
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from FIFO_stock_level_projections_numpy import stock_levels_table
+from ledger import open_ledger
+from reset_running_total_numpy import reset_running_total_table
+
+
+# Streaming mode: the transactions are read in record batches, sorted by product, and every product is calculated
+# as soon as all its transactions have been read. Results are yielded batch by batch, so peak memory is set by the
+# largest product (plus one batch) instead of by the whole dataset.
+
+BATCH_SIZE = 100_000
+
+SORTED_TRANSACTIONS = "select * from {transactions} order by product_code, transaction_date, sort_order, reference_number"
+
+
+def complete_products(batches):
+    """Regroup record batches of transactions sorted by product_code into tables that only hold complete products."""
+    pending = [] # batches with the rows of the last product read so far
+    for batch in batches:
+        if batch.num_rows == 0:
+            continue
+        product_codes = batch.column('product_code')
+        # rows of the last product of the batch may continue in the next batch
+        split = batch.num_rows - pc.sum(pc.equal(product_codes, product_codes[-1])).as_py()
+        if split > 0:
+            yield pa.Table.from_batches(pending + [batch.slice(0, split)])
+            pending = []
+        pending.append(batch.slice(split))
+    if pending:
+        yield pa.Table.from_batches(pending)
+
+
+def stream(con, transactions, calculate, batch_size=BATCH_SIZE):
+    reader = con.sql(SORTED_TRANSACTIONS.format(transactions=transactions)).to_arrow_reader(batch_size)
+    for products in complete_products(reader):
+        yield from calculate(products).to_batches()
+
+
+def stream_result1(con, batch_size=BATCH_SIZE):
+    """Question 1: can we fill the orders? Yields record batches with the columns of result1."""
+    return stream(con, 'fill_transactions', reset_running_total_table, batch_size)
+
+
+def stream_result2(con, batch_size=BATCH_SIZE):
+    """Question 2: will it expire? Yields record batches with the columns of result2."""
+    return stream(con, 'expiry_transactions', reset_running_total_table, batch_size)
+
+
+def stream_stock_levels(con, batch_size=BATCH_SIZE):
+    """FIFO stock level projections. Yields record batches with the columns of stock_levels."""
+    return stream(con, 'fifo_transactions', stock_levels_table, batch_size)
+
+
+if __name__ == '__main__':
+    con = open_ledger()
+    for batch in stream_stock_levels(con, batch_size=10):
+        print(batch.column('product_code')[0], batch.num_rows, 'rows')
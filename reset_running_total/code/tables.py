@@ -0,0 +1,179 @@
+import glob
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import duckdb # documentation available on https://duckdb.org/docs/api/python/overview
+
+
+DATA_DIR = 'reset_running_total/data'
+
+# The input files are loaded with these declared schemas instead of sniffing the dialect and types on every read.
+SCHEMAS = {
+    'customer_orders': {
+        'product_code': 'varchar',
+        'customer_order_number': 'varchar',
+        'qty': 'bigint',
+        'delivery_date': 'date',
+    },
+    'production_orders': {
+        'product_code': 'varchar',
+        'production_order_number': 'varchar',
+        'qty': 'bigint',
+        'production_date': 'date',
+    },
+    'products': {
+        'product_code': 'varchar',
+        'description': 'varchar',
+        'shelf_life_days': 'bigint',
+    },
+    'stock': {
+        'product_code': 'varchar',
+        'batch_number': 'varchar',
+        'qty': 'bigint',
+        'production_date': 'date',
+        'expiration_date': 'date',
+    },
+}
+
+TABLES = list(SCHEMAS)
+
+# Rows with the same product_code and key are the same row: a row that is delivered again (in a later file, or in a
+# scenario, see scenarios.py) replaces the earlier one. (Reference numbers are only unique within a product.)
+KEYS = {
+    'customer_orders': 'customer_order_number',
+    'production_orders': 'production_order_number',
+    'products': 'product_code',
+    'stock': 'batch_number',
+}
+
+# Every table is read from <data_dir>/<table>.csv, or from all csv and parquet files in the directory <data_dir>/<table>
+# and its subdirectories, which can be hive partitioned on columns of the table (e.g. delivery_date=2024-08-01/).
+# `sources` (table: glob pattern) reads a table from other files. The rows of every file are kept in <table>_rows, so
+# only new and changed files are parsed. <table> holds the latest delivery of every row.
+
+SOURCE_FILES = """
+create table if not exists source_files (
+    table_name varchar,
+    path varchar,
+    sha256 varchar,
+    load_number bigint,
+    primary key (table_name, path)
+)
+"""
+
+LATEST_ROWS = """
+create or replace table {table} as
+select {columns}
+from
+    {table}_rows as r
+    join source_files as f
+        on f.table_name = '{table}' and f.path = r.source_file
+qualify
+    row_number() over (partition by r.product_code, r.{key} order by f.load_number desc, r.source_file desc) = 1
+"""
+
+
+def file_hash(path):
+    with open(path, 'rb') as f:
+        return hashlib.file_digest(f, 'sha256').hexdigest()
+
+
+def source_files(table, data_dir=DATA_DIR, sources=None):
+    """Input files of a table, sorted."""
+    if sources and table in sources:
+        paths = glob.glob(sources[table], recursive=True)
+    elif os.path.isfile(f'{data_dir}/{table}.csv'):
+        paths = [f'{data_dir}/{table}.csv']
+    else:
+        paths = [path for extension in ['csv', 'parquet'] for path in glob.glob(f'{data_dir}/{table}/**/*.{extension}', recursive=True)]
+    return sorted(paths)
+
+
+def source_file_hashes(data_dir=DATA_DIR, sources=None):
+    """sha256 of every input file, by table name and path. The files are hashed in parallel."""
+    paths = {table: source_files(table, data_dir, sources) for table in TABLES}
+    with ThreadPoolExecutor() as pool: # hashlib releases the GIL while hashing
+        hashes = dict(zip(
+            [path for table in TABLES for path in paths[table]],
+            pool.map(file_hash, [path for table in TABLES for path in paths[table]]),
+        ))
+    return {table: {path: hashes[path] for path in paths[table]} for table in TABLES}
+
+
+def table_hash(file_hashes):
+    """One sha256 for all input files of a table."""
+    return hashlib.sha256(''.join(f'{path}\t{sha256}\n' for path, sha256 in sorted(file_hashes.items())).encode()).hexdigest()
+
+
+def source_hashes(data_dir=DATA_DIR, sources=None):
+    """sha256 of the input files of every table, by table name."""
+    return {table: table_hash(file_hashes) for table, file_hashes in source_file_hashes(data_dir, sources).items()}
+
+
+def quote(value):
+    return "'" + value.replace("'", "''") + "'"
+
+
+def partition_columns(path, schema):
+    """Columns of the table that are hive partitions in the path of a file."""
+    return tuple(part.split('=', 1)[0] for part in path.split('/')[:-1] if part.split('=', 1)[0] in schema and '=' in part)
+
+
+def read_files(paths, schema):
+    """Query that reads csv and/or parquet files in parallel with the declared schema (and the path of every row's file
+    as source_file). Files with the same format and hive partition columns are read by one table function."""
+    groups = {}
+    for path in paths:
+        groups.setdefault((path.rsplit('.', 1)[-1], partition_columns(path, schema)), []).append(path)
+
+    queries = []
+    for (extension, partitions), group in groups.items():
+        options = ['filename = true']
+        if partitions:
+            hive_types = ', '.join(f"'{column}': '{schema[column]}'" for column in partitions)
+            options += ['hive_partitioning = true', f'hive_types = {{{hive_types}}}']
+        else:
+            options.append('hive_partitioning = false')
+        files = f"[{', '.join(quote(path) for path in group)}]"
+        if extension == 'parquet':
+            source = f"read_parquet({files}, union_by_name = true, {', '.join(options)})"
+        else:
+            columns = ', '.join(f"'{column}': '{column_type}'" for column, column_type in schema.items() if column not in partitions)
+            source = f"read_csv({files}, header = true, delim = ',', auto_detect = false, columns = {{{columns}}}, {', '.join(options)})"
+        columns = ', '.join(f'{column}::{column_type} as {column}' for column, column_type in schema.items())
+        queries.append(f"select {columns}, filename as source_file from {source}")
+    return '\nunion all\n'.join(queries)
+
+
+def load_tables(con, data_dir=DATA_DIR, sources=None):
+    """Load the input files of the four tables into tables on `con`, so queries can refer to them by name.
+    Files whose content did not change since they were loaded into this database are not parsed again, rows of
+    removed files are dropped. Returns the sha256 of the input files of every table, by table name."""
+    con.execute(SOURCE_FILES)
+    load_number = con.sql("select coalesce(max(load_number), 0) + 1 from source_files").fetchone()[0]
+    file_hashes = source_file_hashes(data_dir, sources)
+    for table, schema in SCHEMAS.items():
+        loaded = dict(con.sql("select path, sha256 from source_files where table_name = ?", params=[table]).fetchall())
+        changed = [path for path, sha256 in file_hashes[table].items() if loaded.get(path) != sha256]
+        removed = [path for path in loaded if path not in file_hashes[table]]
+        if not changed and not removed:
+            continue
+
+        columns = ', '.join(f'{column} {column_type}' for column, column_type in schema.items())
+        con.execute(f"create table if not exists {table}_rows ({columns}, source_file varchar)")
+        con.execute(f"delete from {table}_rows where list_contains(?, source_file)", [changed + removed])
+        con.execute("delete from source_files where table_name = ? and list_contains(?, path)", [table, changed + removed])
+        if changed:
+            con.execute(f"insert into {table}_rows {read_files(changed, schema)}")
+            con.executemany("insert into source_files values (?, ?, ?, ?)",
+                            [[table, path, file_hashes[table][path], load_number] for path in changed])
+        con.execute(LATEST_ROWS.format(table=table, columns=', '.join(schema), key=KEYS[table]))
+    return {table: table_hash(hashes) for table, hashes in file_hashes.items()}
+
+
+if __name__ == '__main__':
+    con = duckdb.connect()
+    load_tables(con)
+    for table in TABLES:
+        con.sql(f"select * from {table}").show()